@@ -36,10 +36,13 @@
 # so it doesn't need to sort large sets.
 import random
 import copy
+import heapq
 import provenance_log
-import json
+import journal_codec
 import os
 import shutil 
+import threading
+import time
 
 try:
     from pyblake2 import blake2b
@@ -64,11 +67,15 @@ class Worker:
         self.user = user
         self.command = command
         self.pid = pid
-        self.currentjob = None  # The job currently being processed by us.
+        self.currentjobs = []  # The jobs currently being processed by us.
         # When not set to "S", the module selection policy for load balancing.
         self.module_select_policy = "S"
         # The pollicy for selecting the first job from the anycast set.
         self.job_select_policy = "H"
+        # Milliseconds accept_job may wait for a job if non is available.
+        self.accept_timeout = 0
+        # Maximum number of jobs handed out by a single accept_jobs.
+        self.accept_batch = 1
         self.valid = True  # Make sure we don't try to do cleanup twice.
     def still_running(self):
         if os.path.exists( "/proc/" + str(self.pid)):
@@ -76,15 +83,18 @@ class Worker:
         return False
     # Cleanup all pending state for the worker.
     def teardown(self):
-        # If there is still a job marked as active, we have no other option
-        # than to commit it.
-        if self.currentjob is not None:
-            self.currentjob.commit(worker=self)
-            self.currentjob = None
+        # If there are still jobs marked as active, we have no other option
+        # than to commit them.
+        for job in self.currentjobs:
+            job.commit(worker=self)
+        self.currentjobs = []
         # Unregister the module and make sure we don't do so twice.
         if self.valid:
             self.actor.unregister(handle=self.workerhandle)
             self.valid = False
+            # Don't leave an accept_job for this worker waiting.
+            with self.actor.jobready:
+                self.actor.jobready.notify_all()
 
     # RAIIish way to implicitly clean up state.
     def __del__(self):
@@ -96,27 +106,57 @@ class Worker:
 
     # Accept the next job according to the current job selection pollicy.
     def accept_job(self):
+        handles = self.accept_jobs(count=1)
+        if len(handles) > 0:
+            return handles[0]
+        return None
+
+    # Accept up to count jobs at once, returns the list of their handles.
+    def accept_jobs(self, count):
         # If for any reason we forgat to explicitly forward or commit the
-        # previous job, we have no other option than comitting it now.
-        if self.currentjob is not None:
-            self.currentjob.commit(worker=self)
+        # previous jobs, we have no other option than comitting them now.
+        for job in self.currentjobs:
+            job.commit(worker=self)
+        self.currentjobs = []
+        while len(self.currentjobs) < count:
+            # Only wait for the first job of a batch.
+            job = self._next_job(wait=len(self.currentjobs) == 0)
+            if job is None:
+                break
+            job.worker = self
+            job.provenance.accept(actor=self.actorname,command=self.command,user=self.user)
+            self.currentjobs.append(job)
+            # Kickstart jobs are handed out one at a time.
+            if self.job_select_policy == "K":
+                break
+        # Return the handles of our new current jobs.
+        return [job.jobhandle for job in self.currentjobs]
+
+    # Get the next job according to the current job selection pollicy.
+    def _next_job(self, wait):
         # The "K" job select policy doesn't actually select a job from the
         # anycast set but creates one out of thin air as way to kickstart
         # new data.
         if self.job_select_policy == "K":
-            self.currentjob = self.actor.get_kickjob(worker=self)
-        else:
-            # For all other policies, pop a job from our Actor's anycast set.
-            self.currentjob = self.actor.anycast_pop(
-              module_select_policy=self.module_select_policy,
-              job_select_policy=self.job_select_policy,
-              worker=self)
-        # Return the handle of our new current job.
-        if self.currentjob is not None:
-            self.currentjob.worker = self
-            self.currentjob.provenance.accept(actor=self.actorname,command=self.command,user=self.user)
-            return self.currentjob.jobhandle
-        return None
+            return self.actor.get_kickjob(worker=self)
+        # For all other policies, pop a job from our Actor's anycast set.
+        job = self.actor.anycast_pop(
+          module_select_policy=self.module_select_policy,
+          job_select_policy=self.job_select_policy,
+          worker=self)
+        # If the set is empty and we are allowed to, wait for jobs to
+        # get added.
+        if (job is None and wait and self.accept_timeout > 0 and
+           self.actor.actors.blocking_accept):
+            deadline = time.time() + self.accept_timeout / 1000.0
+            while job is None and self.valid and time.time() < deadline:
+                self.actor.actors.wait_for_job(actor=self.actor,
+                                               deadline=deadline)
+                job = self.actor.anycast_pop(
+                  module_select_policy=self.module_select_policy,
+                  job_select_policy=self.job_select_policy,
+                  worker=self)
+        return job
 
 
 # A one-per-process object for creating sparse capabilities to be used as
@@ -193,7 +233,9 @@ class Job:
         self.actorname = actorname
         # Process the carvpath and flatten or replace with longpath digest if
         # needed.
-        self.carvpath = str(context.parse(carvpath))
+        ent = context.parse(carvpath)
+        self.carvpath = str(ent)
+        self.size = ent.totalsize
         self.router_state = router_state
         self.mime_type = mime_type
         self.file_extension = file_extension
@@ -325,6 +367,20 @@ class Job:
                                          file_extension=extension,
                                          provenance=provenance,
                                          worker=self.worker)
+
+    # Submit a list of (carvpath, nexthop, routerstate, mimetype, extension)
+    # children at once, with a single journal write for all of them.
+    def submit_children(self, children):
+        self.journal.begin_batch()
+        try:
+            for (carvpath, nexthop, routerstate, mimetype,
+                 extension) in children:
+                self.submit_child(carvpath=carvpath, nexthop=nexthop,
+                                  routerstate=routerstate, mimetype=mimetype,
+                                  extension=extension)
+        finally:
+            self.journal.end_batch()
+
     def restorepoint(self):
         self.provenance.restorepoint()
         
@@ -345,12 +401,22 @@ class Actor:
         self.col = col
         self.workers = {}
         self.anycast = {}
+        # Keeps the anycast set ordered for each job select policy used.
+        self.picker = rep.anycast_picker()
+        # Handles of the jobs in the anycast set for each carvpath, oldest
+        # first.
+        self.cp2jobs = {}
+        # Running job count and total carvpath volume of the anycast set.
+        self.set_size = 0
+        self.set_volume = 0
         self.secret = capgen()  # Generate a top-level secret for this actor.
         self.capgen = capgen
         self.weight = 100              # rw extended attribute
         self.overflow = 10             # rw extended attribute
         self.actors = actors
         self.rep = rep
+        # Notified whenever a job gets added to the anycast set.
+        self.jobready = threading.Condition(actors.lock)
 
     def restorepoint(self):
         for jobname in self.anycast:
@@ -389,11 +455,7 @@ class Actor:
 
     # Get the per-actor throttle info.
     def throttle_info(self):    # read-only extended attribute
-        set_size = len(self.anycast)
-        # Fetch the total volume of all entries in the set by asking the
-        # repository.
-        set_volume = self.rep.anycast_set_volume(self.anycast)
-        return (set_size, set_volume)
+        return (self.set_size, self.set_volume)
 
     # Create and add a job to the anycast set for this actor.
     def anycast_add(self, carvpath, router_state, mime_type, file_extension,
@@ -418,6 +480,21 @@ class Actor:
                                       col=self.col,
                                       rep=self.rep,
                                       worker=worker)
+        carvpath = self.anycast[jobhandle].carvpath
+        self.picker.add(carvpath=carvpath)
+        if carvpath not in self.cp2jobs:
+            self.cp2jobs[carvpath] = []
+        self.cp2jobs[carvpath].append(jobhandle)
+        self.set_size += 1
+        self.set_volume += self.anycast[jobhandle].size
+        # Wake up a worker waiting in accept_job, if any, and the load
+        # balancers that may steal jobs from any set.
+        with self.jobready:
+            self.jobready.notify()
+        if "loadbalance" in self.actors.actors:
+            loadbalance = self.actors.actors["loadbalance"]
+            with loadbalance.jobready:
+                loadbalance.jobready.notify()
         return
     # Get a job to do a kickstart with.
     def get_kickjob(self,worker=None):
@@ -437,10 +514,18 @@ class Actor:
             # For normal workers, get a best job from the repository according
             # to the select policy.
             best = self.rep.anycast_best(anycast=self.anycast,
-                                         sort_policy=job_select_policy)
+                                         sort_policy=job_select_policy,
+                                         picker=self.picker,
+                                         cp2jobs=self.cp2jobs)
             if best is not None and best in self.anycast:
                 # Pop the job from our set.
                 job = self.anycast.pop(best)
+                self.picker.remove(carvpath=job.carvpath)
+                self.cp2jobs[job.carvpath].remove(best)
+                if len(self.cp2jobs[job.carvpath]) == 0:
+                    del self.cp2jobs[job.carvpath]
+                self.set_size -= 1
+                self.set_volume -= job.size
                 # Place it in the accessible jobs map.
                 self.jobs[best] = job
                 # Return the Job
@@ -455,25 +540,187 @@ class Actor:
                 return best
         return None
 
+# Durability levels for journal writes:
+#  buffered : Records get gathered and written at most flush_interval
+#             milliseconds later by a background thread.
+#  write    : Records get written at the end of each request or batch.
+#  sync     : As write, but followed by an fdatasync.
+_DURABILITY_LEVELS = ("buffered", "write", "sync")
+
+
+# Thread writing out the records gathered by a buffered JournalFile.
+class _JournalFlusher(threading.Thread):
+    def __init__(self, journal):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.journal = journal
+
+    def run(self):
+        while True:
+            time.sleep(self.journal.interval)
+            self.journal.flush()
+
+
+# Group committing journal writer. Records get gathered in memory and go out
+# with a single write for each request or batch, or each time window.
 class JournalFile:
-    def __init__(self,jfname):
+    def __init__(self, jfname, durability="write", flush_interval=50,
+                 journal_format="json", validsize=None):
+        if durability not in _DURABILITY_LEVELS:
+            raise RuntimeError("Invalid journal durability level '" +
+                               durability + "'")
         self.active_file_name = jfname
         self.previous_file_name = jfname + "-previous"
+        self.encoder = journal_codec.make_encoder(journal_format)
+        # Never mix formats in one file, a journal in the other format gets
+        # moved out of the way.
+        oldformat = journal_codec.file_format(jfname)
+        if oldformat is not None and oldformat != journal_format:
+            self._rotate()
+        elif (validsize is not None and os.path.exists(jfname) and
+              os.path.getsize(jfname) > validsize):
+            # Drop a record cut short by a crash, so new records don't end
+            # up appended to it.
+            with open(jfname, "r+b") as f:
+                f.truncate(validsize)
         self.active_file = open(self.active_file_name, "a", 0)  # Unbuffered journal log.
+        if os.path.getsize(self.active_file_name) == 0:
+            self.active_file.write(self.encoder.header())
+        else:
+            self.active_file.write(self.encoder.reset())
+        self.durability = durability
+        self.interval = flush_interval / 1000.0
+        # Records not yet written and their total size.
+        self.pending = []
+        self.pendingsize = 0
+        # Batch nesting depth and records of the current batch, for each
+        # thread. Records only get encoded once their batch ends, as the
+        # binary format relies on records getting encoded in file order.
+        self.batches = threading.local()
+        self.lock = threading.RLock()
+        if durability == "buffered":
+            _JournalFlusher(self).start()
+    def _depth(self):
+        return getattr(self.batches, "depth", 0)
     def write(self,data):
-        self.active_file.write(data)
-    def newfile(self):
+        if self._depth() > 0:
+            self.batches.records.append((False, data))
+            return
+        with self.lock:
+            self._append(data)
+        self._written()
+    # Write a journal record in the configured format.
+    def record(self, rec):
+        if self._depth() > 0:
+            self.batches.records.append((True, rec))
+            return
+        with self.lock:
+            self._append(self.encoder.encode(rec))
+        self._written()
+    # Add data to the pending records. Called with the lock held.
+    def _append(self, data):
+        self.pending.append(data)
+        self.pendingsize += len(data)
+    def _written(self):
+        # Outside of a batch, a record is a batch of its own. Buffered
+        # journals don't let too much pile up in between time windows.
+        if self.durability != "buffered" or self.pendingsize > 1048576:
+            self.flush()
+    # Group all records written by this thread untill the matching end_batch
+    # into a single write.
+    def begin_batch(self):
+        if self._depth() == 0:
+            self.batches.records = []
+        self.batches.depth = self._depth() + 1
+    def end_batch(self):
+        self.batches.depth -= 1
+        if self.batches.depth > 0:
+            return
+        records = self.batches.records
+        self.batches.records = []
+        if len(records) == 0:
+            return
+        # The whole batch goes into the pending records as a single unit, so
+        # it never gets written out in part.
+        with self.lock:
+            data = []
+            for (isrecord, rec) in records:
+                if isrecord:
+                    data.append(self.encoder.encode(rec))
+                else:
+                    data.append(rec)
+            self._append("".join(data))
+        self._written()
+    # Write out all pending records.
+    def flush(self):
+        with self.lock:
+            if len(self.pending) > 0:
+                self.active_file.write("".join(self.pending))
+                self.pending = []
+                self.pendingsize = 0
+                if self.durability == "sync":
+                    os.fdatasync(self.active_file.fileno())
+    def _rotate(self):
         if os.path.exists(self.previous_file_name):
             os.unlink(self.previous_file_name)
-        self.active_file.close()
         shutil.move(self.active_file_name,self.previous_file_name)
-        self.active_file = open(self.active_file_name, "a", 0) # Unbuffered journal log. 
+    def newfile(self):
+        with self.lock:
+            self.flush()
+            self.active_file.close()
+            self._rotate()
+            self.active_file = open(self.active_file_name, "a", 0) # Unbuffered journal log. 
+            self.active_file.write(self.encoder.header())
     def close(self):
-        self.active_file.close()
+        with self.lock:
+            self.flush()
+            self.active_file.close()
+
+# Thread waking up workers waiting in accept_job once their timeout passes.
+class _AcceptTimer(threading.Thread):
+    def __init__(self, lock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.deadlines = []  # Heap of (deadline, sequence, condition).
+        self.sequence = 0
+        self.wakeup = threading.Condition(lock)
+
+    # Have condition notified at deadline. Called with the lock held.
+    # Returns the entry to cancel once the waiter is done.
+    def add(self, deadline, condition):
+        self.sequence += 1
+        entry = [deadline, self.sequence, condition]
+        heapq.heappush(self.deadlines, entry)
+        self.wakeup.notify()
+        return entry
+
+    # Forget about the deadline of a waiter that is done waiting, so it
+    # won't wake up other waiters for nothing. Called with the lock held.
+    def cancel(self, entry):
+        entry[2] = None
+        while len(self.deadlines) > 0 and self.deadlines[0][2] is None:
+            heapq.heappop(self.deadlines)
+
+    def run(self):
+        with self.wakeup:
+            while True:
+                if len(self.deadlines) == 0:
+                    self.wakeup.wait()
+                else:
+                    remaining = self.deadlines[0][0] - time.time()
+                    if remaining > 0:
+                        self.wakeup.wait(remaining)
+                    else:
+                        condition = heapq.heappop(self.deadlines)[2]
+                        if condition is not None:
+                            condition.notify_all()
+
 
 # State shared between different actors and a central coordination point.
 class Actors:
-    def __init__(self, rep, journal, provenance, context, stack, col):
+    def __init__(self, rep, journal, provenance, context, stack, col,
+                 journal_durability="write", journal_flush_interval=50,
+                 journal_format="json"):
         self.rep = rep
         self.context = context
         self.stack = stack
@@ -482,34 +729,26 @@ class Actors:
         self.workers = {}
         self.jobs = {}
         self.newdata = {}
+        # Serialises all control-plane operations when MattockFS runs
+        # multithreaded. Data-plane reads and writes don't take it.
+        self.lock = threading.RLock()
+        # Only when file-system requests get handled by multiple threads may
+        # accept_job wait for jobs to arrive.
+        self.blocking_accept = False
+        self.accepttimer = None
         self.capgen = CapabilityGenerator()  # Create capability generator.
-        # Unbuffered provenance log.
-        self.provenance_log = open(provenance, "a", 0)
+        # Provenance log, written the same way as the journal.
+        self.provenance_log = JournalFile(
+                                provenance,
+                                durability=journal_durability,
+                                flush_interval=journal_flush_interval)
         # Restoring old state from journal;
-        journalinfo = {}
-        if os.path.exists(journal):
-            with open(journal, 'r') as f:
-                for line in f:
-                    line = line.rstrip().encode('ascii', 'ignore')
-                    dat = json.loads(line)
-                    dtype = dat["type"]
-                    if dtype == "NEW":
-                        dkey = dat["key"]
-                        journalinfo[dkey] = []
-                        journalinfo[dkey].append(dat["provenance"])
-                    else:
-                        if  dtype == "UPD":
-                            dkey = dat["key"] 
-                            journalinfo[dkey].append(dat["provenance"])
-                        else:
-                            if dtype == "FNL":
-                                dkey = dat["key"]
-                                del journalinfo[dkey]
-                            else:
-                                if dtype == "RPENT":
-                                    dkey = dat["key"]
-                                    journalinfo[dkey] = dat["provenance"]
-        self.journal = JournalFile(journal)
+        (journalinfo, validsize) = journal_codec.replay(journal)
+        self.journal = JournalFile(journal,
+                                   durability=journal_durability,
+                                   flush_interval=journal_flush_interval,
+                                   journal_format=journal_format,
+                                   validsize=validsize)
         self.ticks = 0
         if len(journalinfo) > 0:
             for needrestore in journalinfo:
@@ -517,11 +756,40 @@ class Actors:
                 self.journal_restore(provenance_log,needrestore)
     def restorepoint(self):
         self.journal.newfile()
-        self.journal.write("{\"type\" : \"RESTOREPOINT\", \"jobcount\" : " + str(len(self.jobs)) + " }\n")
+        self.journal.record({"type": "RESTOREPOINT",
+                             "jobcount": len(self.jobs)})
         for jobkey in self.jobs:
             self.jobs[jobkey].restorepoint()
         for actorname in self.actors:
             self.actors[actorname].restorepoint()
+    # Group the journal and provenance log records of a single request.
+    def begin_batch(self):
+        self.journal.begin_batch()
+        self.provenance_log.begin_batch()
+
+    def end_batch(self):
+        self.provenance_log.end_batch()
+        self.journal.end_batch()
+
+    # Write out any journal and provenance log records still pending.
+    def flush(self):
+        self.journal.flush()
+        self.provenance_log.flush()
+
+    # Wait untill a job gets added to the anycast set of actor, or untill the
+    # deadline passes. The lock is released while waiting.
+    def wait_for_job(self, actor, deadline):
+        with actor.jobready:
+            if self.accepttimer is None:
+                self.accepttimer = _AcceptTimer(self.lock)
+                self.accepttimer.start()
+            entry = self.accepttimer.add(deadline=deadline,
+                                         condition=actor.jobready)
+            try:
+                actor.jobready.wait()
+            finally:
+                self.accepttimer.cancel(entry)
+
     def tick(self):
         self.ticks = self.ticks + 1
         if self.ticks == 4096:
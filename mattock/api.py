@@ -36,7 +36,7 @@ import os
 import os.path
 import re
 import json
-from time import sleep
+from time import sleep, time
 import carvpath
 
 
@@ -160,6 +160,26 @@ class _Job:
             self.ctl["user.submit_child"] = val.encode()
             self.newdata = None
 
+    # Submit a list of (carvpath, nextactor, routerstate, mimetype,
+    # extension) tuples as children of the current job, using as few
+    # file-system requests as possible.
+    def childsubmit_many(self, children):
+        if self.isdone is False:
+            batch = []
+            batchsize = 0
+            for child in children:
+                val = ";".join(child).encode()
+                # Extended attribute values are limited to 64KiB.
+                if batchsize + len(val) + 1 > 65536 and len(batch) > 0:
+                    self.ctl["user.submit_children"] = "\n".join(batch)
+                    batch = []
+                    batchsize = 0
+                batch.append(val)
+                batchsize += len(val) + 1
+            if len(batch) > 0:
+                self.ctl["user.submit_children"] = "\n".join(batch)
+            self.newdata = None
+
     # Mark the job as done without specifying a new target. This should close
     # and flush the provenance log for the toolchain this jib belongs to.
     def done(self):
@@ -194,6 +214,7 @@ class _Context:
                                      ".ctl")
         # Register as worker with MattockFS
         self.worker_ctl = None
+        self.batchsize = 1
         path = self.actor_ctl["user.register_worker"]
         self.worker_ctl = xattr.xattr(self.mountpoint + "/" + path)
         # Set job select policy if supplied as constructor argument
@@ -235,15 +256,64 @@ class _Context:
                     job_ctl=self.mountpoint + "/" + job,
                     context=self.context)
 
+    # Fetch up to n jobs at once, returns a possibly empty list. Jobs from an
+    # earlier fetch that weren't forwarded or marked as done get committed.
+    def poll_jobs(self, n):
+        if n != self.batchsize:
+            self.worker_ctl["user.accept_batch"] = str(n)
+            self.batchsize = n
+        try:
+            jobs = self.worker_ctl["user.accept_jobs"]
+        except:
+            return []
+        return [_Job(mp=self.mountpoint,
+                     job_ctl=self.mountpoint + "/" + job,
+                     context=self.context) for job in jobs.split("\n")]
+
+    # Set the number of milliseconds that poll_job may wait for a job to
+    # arrive if non is available. Only a multithreaded MattockFS waits.
+    def set_accept_timeout(self, timeout):
+        self.worker_ctl["user.accept_timeout"] = str(timeout)
+
     # Get the next job, if non is available, keep polling until one is.
     def get_job(self):
+        # Let the file-system hold each poll untill a job arrives.
+        try:
+            self.set_accept_timeout(timeout=1000)
+        except (IOError, OSError):
+            # Older MattockFS versions don't know about accept timeouts.
+            pass
         while True:
+            polltime = time()
             job = self.poll_job()
             if job is None:
-                sleep(0.05)
+                # Only sleep if the poll didn't wait.
+                remaining = 0.05 - (time() - polltime)
+                if remaining > 0:
+                    sleep(remaining)
             else:
                 yield job
 
+    # Get the next batch of up to n jobs, if non are available, keep polling
+    # until some are.
+    def get_jobs(self, n):
+        # Let the file-system hold each poll untill a job arrives.
+        try:
+            self.set_accept_timeout(timeout=1000)
+        except (IOError, OSError):
+            # Older MattockFS versions don't know about accept timeouts.
+            pass
+        while True:
+            polltime = time()
+            jobs = self.poll_jobs(n=n)
+            if len(jobs) == 0:
+                # Only sleep if the poll didn't wait.
+                remaining = 0.05 - (time() - polltime)
+                if remaining > 0:
+                    sleep(remaining)
+            else:
+                yield jobs
+
     # Set the weight for the actor itself. Used in selecting a module anycast
     # set for use in load balancing.
     def actor_set_weight(self, weight):
@@ -297,6 +367,21 @@ class MountPoint:
         st = self.main_ctl["user.fadvise_status"].split(";")
         return {"normal": int(st[0]), "dontneed": int(st[1])}
 
+    # Request the hit/miss statistics of the MattockFS carvpath parse cache.
+    def parse_cache_status(self):
+        st = self.main_ctl["user.parse_cache_status"].split(";")
+        return {"hits": int(st[0]), "misses": int(st[1]),
+                "entries": int(st[2])}
+
+    # Request the per policy letter hit/miss statistics of the job select
+    # sort value cache.
+    def sortkey_cache_status(self):
+        rval = {}
+        for entry in self.main_ctl["user.sortkey_cache_status"].split(";"):
+            (letter, hits, misses) = entry.split(":")
+            rval[letter] = {"hits": int(hits), "misses": int(misses)}
+        return rval
+
     # Request a CarvPathFile object  for the archive as a whole.
     def full_archive(self):
         return _CarvPathFile(self.mountpoint,
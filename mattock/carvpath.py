@@ -28,9 +28,11 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
 #
-import copy
+import bisect
+import collections
 import os
 import fcntl
+import threading
 
 
 try:
@@ -48,7 +50,12 @@ except ImportError:  # pragma: no cover
 
 
 # A fragent represents a contiguous section of a higher level data entity.
-class Fragment:
+# Fragments are kept small using __slots__ as there may be millions of them
+# alive at any time. Once part of an entity, a fragment is never grown in
+# place, so entities may freely share their fragments.
+class Fragment(object):
+    __slots__ = ("offset", "size")
+
     # Constructor can either be called with a fragment carvpath token string
     # or with an offset and size.
     # A fragment carvpath token string is formatted like '<offset>+<size>',
@@ -120,7 +127,9 @@ class Fragment:
 # A Sparse object represents a higher level sparse definition that can be
 # thought of as
 # empty space that has no immage on any lower level data.
-class Sparse:
+class Sparse(object):
+    __slots__ = ("size",)
+
     # Constructor can either be called with a sparse carvpath token string or
     # with a size.
     # A sparse carvpath token string has the form 'S<size>',
@@ -192,7 +201,10 @@ def _asfrag(fragstring):
 
 # An entity is an ordered  collection of Fragment and/or Sparse objects.
 # Entities are the core concept within pycarvpath.
-class _Entity:
+class _Entity(object):
+    __slots__ = ("longpathmap", "maxfstoken", "fragments", "totalsize",
+                 "_str")
+
     # An Entity constructor takes either a carvpath, a list of pre-made
     # fragments or no constructor argument at all if you wish to create a new
     # empty Entity. You should probably not be instantiating your own _Entity
@@ -204,6 +216,8 @@ class _Entity:
     def __init__(self, lpmap, maxfstoken, carvpath=None, fragments=None):
         self.longpathmap = lpmap
         self.maxfstoken = maxfstoken
+        # Memoised carvpath string (or digest), dropped on any mutation.
+        self._str = None
         if fragments is None:
             fragments = []
         self.fragments = []
@@ -226,15 +240,19 @@ class _Entity:
             fragments = []
             for frag in self.fragments:
                 if frag.issparse() == False:
-                    fragments.append(frag.copy())
-            return _Entity(lpmap=self.longpathmap,
-                           maxfstoken=self.maxfstoken,
-                           fragments=fragments)
+                    fragments.append(frag)
+            return self.__class__(lpmap=self.longpathmap,
+                                  maxfstoken=self.maxfstoken,
+                                  fragments=fragments)
         else:
-            return _Entity(
-                    lpmap=self.longpathmap,
-                    maxfstoken=self.maxfstoken,
-                    fragments=copy.deepcopy(self.fragments))
+            # Fragments are never modified in place, so a slice of our
+            # fragment list is all the copy we need.
+            rval = self.__class__(lpmap=self.longpathmap,
+                                  maxfstoken=self.maxfstoken)
+            rval.fragments = self.fragments[:]
+            rval.totalsize = self.totalsize
+            rval._str = self._str
+            return rval
 
     # Use a secure hash function to get a shorter representation of carvpath.
     # Than register the shorter representation  in redis so we can find the
@@ -257,9 +275,12 @@ class _Entity:
     # Grow the entity by extending on its final fragment or, if there are non,
     # by creating a first fragment with offset zero.
     def grow(self, chunksize):
+        self._str = None
         if len(self.fragments) == 0:
             self.fragments.append(Fragment(offset=0, size=chunksize))
         else:
+            # The last fragment may be shared with other entities.
+            self.fragments[-1] = self.fragments[-1].copy()
             self.fragments[-1].grow(sz=chunksize)
         self.totalsize += chunksize
 
@@ -268,15 +289,18 @@ class _Entity:
         # Anything of zero size is represented as zero size sparse region.
         if len(self.fragments) == 0:
             return "S0"
-        # Apply a cast to string on each of the fragment and concattenate the
-        # result using '_' as join character.
-        rval = "_".join(map(str, self.fragments))
-        # If needed, store long carvpath in database and replace the long
-        # carvpath with its digest.
-        if len(rval) > self.maxfstoken:
-            return self._asdigest(rval)
-        else:
-            return rval
+        # Only compose the string, and only store a long carvpath in the
+        # database, the first time around after creation or mutation.
+        if self._str is None:
+            # Apply a cast to string on each of the fragment and concattenate
+            # the result using '_' as join character.
+            rval = "_".join(map(str, self.fragments))
+            # If needed, store long carvpath in database and replace the long
+            # carvpath with its digest.
+            if len(rval) > self.maxfstoken:
+                rval = self._asdigest(rval)
+            self._str = rval
+        return self._str
 
     def __hash__(self):
         return hash(str(self))
@@ -353,6 +377,7 @@ class _Entity:
     # Python does not allow overloading of any operator+= ; this method
     # pretends it does. Implements : ent += other.
     def unaryplus(self, other):
+        self._str = None
         if isinstance(other, _Entity):
             # We can either append a whole Entity
             for index in range(0, len(other.fragments)):
@@ -378,7 +403,8 @@ class _Entity:
     # Appending two entities together, merging the tails if possible.
     def __add__(self, other):
         # Express a+b in terms of operator+=
-        rval = _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        rval = self.__class__(lpmap=self.longpathmap,
+                              maxfstoken=self.maxfstoken)
         rval.unaryplus(other=self)
         rval.unaryplus(other=other)
         return rval
@@ -434,7 +460,8 @@ class _Entity:
 
     # Get the projection of an entity as sub entity of an other entity.
     def subentity(self, childent, truncate=False):
-        subentity = _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        subentity = self.__class__(lpmap=self.longpathmap,
+                                   maxfstoken=self.maxfstoken)
         for childfrag in childent.fragments:
             if childfrag.issparse():
                 subentity.unaryplus(other=childfrag)
@@ -449,14 +476,15 @@ class _Entity:
     def assigntoself(self, other):
         self.fragments = other.fragments
         self.totalsize = other.totalsize
+        self._str = None
 
     # Strip the entity of its sparse fragments and sort itsd non sparse
     # fragments.
     # This is meant to be used for reference counting purposes inside of
     # the Box.
     def stripsparse(self):
-        newfragment = _Entity(lpmap=self.longpathmap,
-                              maxfstoken=self.maxfstoken)
+        newfragment = self.__class__(lpmap=self.longpathmap,
+                                     maxfstoken=self.maxfstoken)
         nosparse = []
         for i in range(len(self.fragments)):
             if self.fragments[i].issparse() == False:
@@ -623,8 +651,8 @@ def _fragapply(ent1, ent2, bflist=None, test=None):
     # Create an array with Entity objects, one per lambda.
     rval = []
     for index in range(0, len(bflist)):
-        rval.append(_Entity(lpmap=ent1.longpathmap,
-                            maxfstoken=ent1.maxfstoken))
+        rval.append(ent1.__class__(lpmap=ent1.longpathmap,
+                                   maxfstoken=ent1.maxfstoken))
     # Fill each entity with fragments depending on the appropriate lambda
     # invocation result.
     for index in range(0, len(chunks)):
@@ -638,17 +666,199 @@ def _fragapply(ent1, ent2, bflist=None, test=None):
     return rval
 
 
+# Helper function for getting the sorted start and end offsets of a list of
+# fragments. This only works for what stripsparse and merge normally leave
+# behind: non sparse fragments in increasing order with a gap between each
+# of them. For anything else None is returned.
+def _runs(fragments):
+    starts = []
+    ends = []
+    for frag in fragments:
+        if frag.issparse() or (len(ends) > 0 and frag.offset <= ends[-1]):
+            return None
+        starts.append(frag.offset)
+        ends.append(frag.offset + frag.size)
+    return (starts, ends)
+
+
+# Helper generator for walking two sorted lists of runs at the same time.
+# Yields the start, end and membership of each stretch that is part of either
+# list.
+def _sweep(starts1, ends1, starts2, ends2):
+    points = sorted(set(starts1 + ends1 + starts2 + ends2))
+    index1 = 0
+    index2 = 0
+    for index in range(0, len(points) - 1):
+        start = points[index]
+        while index1 < len(ends1) and ends1[index1] <= start:
+            index1 += 1
+        while index2 < len(ends2) and ends2[index2] <= start:
+            index2 += 1
+        inone = index1 < len(starts1) and starts1[index1] <= start
+        intwo = index2 < len(starts2) and starts2[index2] <= start
+        if inone or intwo:
+            yield (start, points[index + 1], inone, intwo)
+
+
+# An _Entity that keeps a sorted offset index of its fragments. With this
+# index merge, unmerge, overlaps, overlap_size and density only visit the
+# part of the entity that the other entity spans, rather than walking both
+# entities in full. The index is only used if both entities are sorted and
+# sparse-stripped, for anything else the _Entity implementation is used, so
+# results are always the same as for _Entity. Create these by invoking
+# 'parse' on a Context constructed with indexed=True.
+class _IndexedEntity(_Entity):
+    __slots__ = ("_starts", "_ends")
+
+    def __init__(self, lpmap, maxfstoken, carvpath=None, fragments=None):
+        # The index is created lazily and dropped on any mutation other than
+        # merge and unmerge. False means our fragments can't be indexed.
+        self._starts = None
+        self._ends = None
+        _Entity.__init__(self, lpmap=lpmap, maxfstoken=maxfstoken,
+                         carvpath=carvpath, fragments=fragments)
+
+    # Get (and if needed create) the start and end offset index, or None if
+    # our fragments can't be indexed.
+    def _index(self):
+        if self._starts is None:
+            runs = _runs(self.fragments)
+            if runs is None:
+                self._starts = False
+            else:
+                (self._starts, self._ends) = runs
+        if self._starts is False:
+            return None
+        return (self._starts, self._ends)
+
+    # Get the index together with the part of it spanned by entity, or None
+    # if either of the two can't be indexed.
+    def _window(self, entity):
+        own = self._index()
+        if own is None:
+            return None
+        if isinstance(entity, _IndexedEntity):
+            other = entity._index()
+        else:
+            other = _runs(entity.fragments)
+        if other is None:
+            return None
+        (starts, ends) = own
+        (otherstarts, otherends) = other
+        if len(otherstarts) == 0:
+            return (own, other, len(starts), len(starts))
+        # Include our runs that are merely adjacent, merge joins those.
+        lo = bisect.bisect_left(ends, otherstarts[0])
+        hi = bisect.bisect_right(starts, otherends[-1])
+        return (own, other, lo, hi)
+
+    def grow(self, chunksize):
+        self._starts = None
+        _Entity.grow(self, chunksize=chunksize)
+
+    def unaryplus(self, other):
+        self._starts = None
+        _Entity.unaryplus(self, other=other)
+
+    def assigntoself(self, other):
+        self._starts = None
+        _Entity.assigntoself(self, other=other)
+
+    # Replace our runs lo..hi by the fragments of ent.
+    def _splice(self, lo, hi, ent):
+        self.fragments[lo:hi] = ent.fragments
+        self._starts[lo:hi] = [frag.offset for frag in ent.fragments]
+        self._ends[lo:hi] = [frag.offset + frag.size
+                             for frag in ent.fragments]
+        self._str = None
+
+    # Walk the spanned part of both entities and fill one new entity per
+    # lambda, just like _fragapply does for the whole of both entities.
+    def _windowapply(self, window, bflist):
+        ((starts, ends), (otherstarts, otherends), lo, hi) = window
+        rval = []
+        for index in range(0, len(bflist)):
+            rval.append(self.__class__(lpmap=self.longpathmap,
+                                       maxfstoken=self.maxfstoken))
+        for (start, end, inone, intwo) in _sweep(starts[lo:hi], ends[lo:hi],
+                                                 otherstarts, otherends):
+            for index in range(0, len(bflist)):
+                if bflist[index](inone, intwo):
+                    rval[index].unaryplus(other=Fragment(offset=start,
+                                                         size=end - start))
+        return rval
+
+    def merge(self, entity):
+        window = self._window(entity)
+        if window is None:
+            return _Entity.merge(self, entity)
+        rval = self._windowapply(window, [
+                 (lambda a, b: a or b),
+                 (lambda a, b: a and b),
+                 (lambda a, b: (not a) and b)])
+        self._splice(window[2], window[3], rval[0])
+        self.totalsize += rval[2].totalsize
+        return rval[1:]
+
+    def unmerge(self, entity):
+        window = self._window(entity)
+        if window is None:
+            return _Entity.unmerge(self, entity)
+        rval = self._windowapply(window, [
+                 (lambda a, b: a and (not b)),
+                 (lambda a, b: (not a) and b),
+                 (lambda a, b: a and b)])
+        self._splice(window[2], window[3], rval[0])
+        self.totalsize -= rval[2].totalsize
+        return rval[1:]
+
+    def overlaps(self, entity):
+        window = self._window(entity)
+        if window is None:
+            return _Entity.overlaps(self, entity)
+        ((starts, ends), (otherstarts, otherends), lo, hi) = window
+        for index in range(0, len(otherstarts)):
+            index2 = bisect.bisect_right(ends, otherstarts[index], lo, hi)
+            if index2 < hi and starts[index2] < otherends[index]:
+                return True
+        return False
+
+    # Size of the part of entity that we overlap with.
+    def _overlap_size(self, window):
+        rval = 0
+        ((starts, ends), (otherstarts, otherends), lo, hi) = window
+        for (start, end, inone, intwo) in _sweep(starts[lo:hi], ends[lo:hi],
+                                                 otherstarts, otherends):
+            if inone and intwo:
+                rval += end - start
+        return rval
+
+    def overlap_size(self, entity):
+        window = self._window(entity)
+        if window is None:
+            return _Entity.overlap_size(self, entity)
+        return self._overlap_size(window)
+
+    def density(self, entity):
+        window = self._window(entity)
+        if window is None:
+            return _Entity.density(self, entity)
+        return float(self._overlap_size(window))/float(self.totalsize)
+
+
 # This object allows an Entity to be validated against an underlying data
 # source with a given size.
 class _Top:
     # Don instantiate a _Top, Instantiate a Context and use
     # Context::make_top instead.
-    def __init__(self, lpmap, maxfstoken, size=0):
+    def __init__(self, lpmap, maxfstoken, size=0, entityclass=None):
+        if entityclass is None:
+            entityclass = _Entity
         self.size = size
-        self.topentity = _Entity(lpmap=lpmap,
-                                 maxfstoken=maxfstoken,
-                                 fragments=[Fragment(offset=0,
-                                                     size=size)])
+        self.topentity = entityclass(lpmap=lpmap,
+                                     maxfstoken=maxfstoken,
+                                     fragments=[Fragment(offset=0,
+                                                         size=size)])
 
     # Get this Top object as an Entity.
     def entity():
@@ -670,6 +880,38 @@ class _Top:
         return True
 
 
+# Bounded least-recently-used cache of parsed entities, keyed by the carvpath
+# string they were parsed from.
+class _ParseCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entities = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # OrderedDict isn't thread safe.
+        self.lock = threading.Lock()
+
+    # Get a cached entity, or None if the path wasn't parsed recently.
+    def get(self, path):
+        with self.lock:
+            ent = self.entities.pop(path, None)
+            if ent is None:
+                self.misses += 1
+                return None
+            # Re-insert as to mark the entity as most recently used.
+            self.entities[path] = ent
+            self.hits += 1
+            return ent
+
+    # Add a freshly parsed entity, dropping the least recently used one if
+    # we are full.
+    def add(self, path, ent):
+        with self.lock:
+            self.entities[path] = ent
+            if len(self.entities) > self.maxsize:
+                self.entities.popitem(last=False)
+
+
 # You need one of these per application in order to use pycarvpath.
 class Context:
     # A Context needs a dict like object that implements persistent (and
@@ -679,9 +921,20 @@ class Context:
     # by a 65 byte long token stored in this pseudo dict. You may specify a
     # different maximum carvpath lengt if you wish for a longer or shorter
     # treshold.
-    def __init__(self, lpmap, maxtokenlen=160):
+    # If cachesize is larger than zero, up to that many of the most recently
+    # parsed carvpaths are kept so they don't need to be parsed again.
+    # If indexed is set to True, all entities created through the Context
+    # keep a sorted offset index for faster merge, unmerge and overlap
+    # operations on large and highly fragmented entities.
+    def __init__(self, lpmap, maxtokenlen=160, cachesize=0, indexed=False):
         self.longpathmap = lpmap
         self.maxfstoken = maxtokenlen
+        self.entityclass = _Entity
+        if indexed:
+            self.entityclass = _IndexedEntity
+        self.cache = None
+        if cachesize > 0:
+            self.cache = _ParseCache(maxsize=cachesize)
 
     # Parse a (possibly nested) carvpath and return an Entity object.
     # This method will throw if a carvpath string is invalid. It will however
@@ -689,22 +942,39 @@ class Context:
     # If you wish to do so, create a Top object and invoke Top::test(ent) with
     # the Entity you got back from parse.
     def parse(self, path):
+        if self.cache is not None:
+            ent = self.cache.get(path)
+            if ent is not None:
+                # Callers may modify what we return, so hand out a copy and
+                # keep the cached entity pristine.
+                return ent.copy()
         levelmin = None
         for level in path.split("/"):
-            level = _Entity(lpmap=self.longpathmap,
-                            maxfstoken=self.maxfstoken,
-                            carvpath=level)
+            level = self.entityclass(lpmap=self.longpathmap,
+                                     maxfstoken=self.maxfstoken,
+                                     carvpath=level)
             if levelmin is not None:
                 level = levelmin.subentity(childent=level)
             levelmin = level
+        if self.cache is not None:
+            self.cache.add(path, level.copy())
         return level
 
+    # Get the parse cache hit count, miss count and number of cached
+    # entities.
+    def cache_info(self):
+        if self.cache is None:
+            return (0, 0, 0)
+        return (self.cache.hits, self.cache.misses, len(self.cache.entities))
+
     # Cheate a Top object to validate parsed entities against.
     def make_top(self, size=0):
-        return _Top(self.longpathmap, self.maxfstoken, size)
+        return _Top(self.longpathmap, self.maxfstoken, size,
+                    self.entityclass)
 
     def empty(self):
-        return _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        return self.entityclass(lpmap=self.longpathmap,
+                                maxfstoken=self.maxfstoken)
 
 
 class _Test:  # pragma: no cover
@@ -774,9 +1044,9 @@ class _Test:  # pragma: no cover
             print("OK: in='" + pin + "' expected='" + str(sz) + "' result='" +
                   str(a.totalsize) + "'")
 
-    def testmerge(self, p1, p2, pout):
+    def testmerge(self, p1, p2, pout, indexed=False):
         print("TESTMERGE:")
-        context = Context({})
+        context = Context({}, indexed=indexed)
         a = context.parse(p1)
         a.stripsparse()
         b = context.parse(p2)
@@ -788,6 +1058,30 @@ class _Test:  # pragma: no cover
         else:
             print("OK : "+str(a))
 
+    def testsetops(self, p1, p2):
+        print("TESTSETOPS:")
+        results = []
+        for indexed in (False, True):
+            context = Context({}, indexed=indexed)
+            result = []
+            for op in ("merge", "unmerge", "overlaps", "overlap_size",
+                       "density"):
+                a = context.parse(p1)
+                b = context.parse(p2)
+                try:
+                    rval = getattr(a, op)(b)
+                except Exception as e:
+                    rval = e.__class__.__name__
+                if isinstance(rval, list):
+                    rval = map(str, rval)
+                result.append((op, str(a), rval))
+            results.append(result)
+        if results[0] != results[1]:
+            print("FAIL : " + p1 + " " + p2 + " " + str(results[0]) +
+                  " != " + str(results[1]))
+        else:
+            print("OK : " + p1 + " " + p2)
+
 
 if __name__ == "__main__":  # pragma: no cover
     import redislongpathmap as longpathmap
@@ -839,6 +1133,13 @@ if __name__ == "__main__":  # pragma: no cover
     t.testflatten(context, "D901141262aa24eaaddbce2f470615b6a47639f7a62b3bc7c"
                            "65335251fe3fa480/350+100", "353+50_404+50")
     t.testflatten(context, "S200000/1000+9000", "S9000")
+    cachedcontext = Context(lpmap, cachesize=2)
+    for index in range(0, 2):
+        t.testflatten(cachedcontext, "0+20000_40000+20000/10000+20000",
+                                     "10000+10000_40000+10000")
+        t.testflatten(cachedcontext, "S200000/1000+9000", "S9000")
+    print("Parse cache hits/misses/entries: " +
+          str(cachedcontext.cache_info()))
     t.testrange(200000000000, "0+100000000000/0+50000000", True)
     t.testrange(20000, "0+100000000000/0+50000000", False)
     t.testsize(context, "20000+0_89765+0", 0)
@@ -852,13 +1153,32 @@ if __name__ == "__main__":  # pragma: no cover
     t.testadd("0+1000_S2000_1000+2000", "3000+1000_6000+1000",
               "0+1000_S2000_1000+3000_6000+1000")
     t.testadd("0+1000_S2000", "S1000_3000+1000", "0+1000_S3000_3000+1000")
-    t.testmerge("0+1000_2000+1000", "500+2000", "0+3000")
-    t.testmerge("2000+1000_5000+100",
-                "100+500_800+800_4000+200_6000+100_7000+100",
-                "100+500_800+800_2000+1000_4000+200_5000+100_6000+100_7000"
-                "+100")
-    t.testmerge("2000+1000_5000+1000", "2500+500", "2000+1000_5000+1000")
-    t.testmerge("500+2000", "0+1000_2000+1000", "0+3000")
-    t.testmerge("0+1000_2000+1000", "500+1000", "0+1500_2000+1000")
-    t.testmerge("S0", "0+1000_2000+1000", "0+1000_2000+1000")
-    t.testmerge("0+60000", "15000+30000", "0+60000")
+    for indexed in (False, True):
+        t.testmerge("0+1000_2000+1000", "500+2000", "0+3000",
+                    indexed=indexed)
+        t.testmerge("2000+1000_5000+100",
+                    "100+500_800+800_4000+200_6000+100_7000+100",
+                    "100+500_800+800_2000+1000_4000+200_5000+100_6000+100_"
+                    "7000+100", indexed=indexed)
+        t.testmerge("2000+1000_5000+1000", "2500+500", "2000+1000_5000+1000",
+                    indexed=indexed)
+        t.testmerge("500+2000", "0+1000_2000+1000", "0+3000",
+                    indexed=indexed)
+        t.testmerge("0+1000_2000+1000", "500+1000", "0+1500_2000+1000",
+                    indexed=indexed)
+        t.testmerge("S0", "0+1000_2000+1000", "0+1000_2000+1000",
+                    indexed=indexed)
+        t.testmerge("0+60000", "15000+30000", "0+60000", indexed=indexed)
+    # The indexed entity should give the same results as the plain one, also
+    # for entities it can't index.
+    for (p1, p2) in [("0+1000_2000+1000", "500+2000"),
+                     ("2000+1000_5000+1000", "2500+500"),
+                     ("0+1000_2000+1000", "1000+1000"),
+                     ("0+1000_2000+1000", "3000+1000"),
+                     ("0+1000_5000+1000", "2000+1000"),
+                     ("S0", "0+1000_2000+1000"),
+                     ("0+1000_2000+1000", "S0"),
+                     ("0+1000_500+1000", "700+1000"),
+                     ("2000+1000_0+1000", "500+2000"),
+                     ("0+1000_S500_2000+1000", "500+2000")]:
+        t.testsetops(p1, p2)
@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# Copyright (c) 2015, Rob J Meijer.
+# Copyright (c) 2015, University College Dublin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the <organization>.
+# 4. Neither the name of the <organization> nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY <COPYRIGHT HOLDER> ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
+#
+# Encoding and replay of the anycast journal. Next to the original one JSON
+# object per line format there is a compact binary format. A binary journal
+# starts with a magic header, followed by records that each consist of a four
+# byte little endian length and a body. The body starts with a record type
+# byte. Job records (NEW, UPD, FNL and RPENT) continue with the 32 byte raw
+# job key and the encoded provenance. Actor names, commands, user names and
+# the like are interned: each new string is defined once in a string record
+# and further on referred to by its index.
+#
+import json
+import struct
+import binascii
+
+MAGIC = "MattockJournal\x00\x01"
+
+# Record types for job records, these carry a raw key.
+_KEYED_TYPES = {"NEW": "N", "UPD": "U", "FNL": "F", "RPENT": "R"}
+_KEYED_NAMES = dict((v, k) for k, v in _KEYED_TYPES.items())
+# Other record types.
+_STRING_RECORD = "S"  # Definition of the next interned string.
+_RESET_RECORD = "Z"   # Start of a new string table.
+_OTHER_RECORD = "X"   # Any other record, encoded as a whole.
+# Field values that are interned, on top of all field names.
+_INTERNED_FIELDS = frozenset(["actor", "command", "user", "mime",
+                              "extension", "router_state", "type"])
+# Don't let a string table grow without bounds, beyond this many entries new
+# strings get stored inline.
+_MAX_STRINGS = 65536
+_LENGTH = struct.Struct("<I")
+_DOUBLE = struct.Struct("<d")
+
+
+def _varint(num):
+    rval = []
+    while num > 127:
+        rval.append(chr((num & 127) | 128))
+        num >>= 7
+    rval.append(chr(num))
+    return "".join(rval)
+
+
+def _read_varint(data, pos):
+    num = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        num |= (byte & 127) << shift
+        if byte < 128:
+            return num, pos
+        shift += 7
+
+
+# Encoder for the original JSON journal format.
+class JsonEncoder:
+    def header(self):
+        return ""
+
+    # Records written after this are readable without any earlier state.
+    def reset(self):
+        return ""
+
+    def encode(self, rec):
+        return json.dumps(rec, sort_keys=True) + "\n"
+
+
+# Encoder for the binary journal format, keeps the string table of the
+# journal file being written.
+class BinaryEncoder:
+    def __init__(self):
+        self.strings = {}
+
+    def header(self):
+        self.strings = {}
+        return MAGIC
+
+    # Start a new string table when appending to an existing journal file.
+    def reset(self):
+        self.strings = {}
+        return _LENGTH.pack(1) + _RESET_RECORD
+
+    def _string(self, val, out, intern):
+        if isinstance(val, unicode):
+            val = val.encode("utf8")
+        if intern:
+            if val in self.strings:
+                return "r" + _varint(self.strings[val])
+            if len(self.strings) < _MAX_STRINGS:
+                self.strings[val] = len(self.strings)
+                out.append(_LENGTH.pack(len(val) + 1) + _STRING_RECORD + val)
+                return "r" + _varint(self.strings[val])
+        return "s" + _varint(len(val)) + val
+
+    def _value(self, val, out, intern=False):
+        if isinstance(val, basestring):
+            return self._string(val, out, intern)
+        if val is True:
+            return "T"
+        if val is False:
+            return "F"
+        if val is None:
+            return "0"
+        if isinstance(val, float):
+            return "d" + _DOUBLE.pack(val)
+        if isinstance(val, (int, long)):
+            if val < 0:
+                return "-" + _varint(-val)
+            return "i" + _varint(val)
+        if isinstance(val, (list, tuple)):
+            return "l" + _varint(len(val)) + "".join(
+                self._value(sub, out) for sub in val)
+        if isinstance(val, dict):
+            parts = ["m", _varint(len(val))]
+            for key in sorted(val):
+                parts.append(self._string(key, out, True))
+                parts.append(self._value(val[key], out,
+                                         key in _INTERNED_FIELDS))
+            return "".join(parts)
+        raise RuntimeError("Can't encode " + repr(val) + " in journal")
+
+    # Returns the encoded record, preceded by any new string records.
+    def encode(self, rec):
+        out = []
+        rtype = rec.get("type")
+        key = rec.get("key")
+        if (rtype in _KEYED_TYPES and len(rec) == 3 and
+                isinstance(key, basestring) and len(key) == 64):
+            body = (_KEYED_TYPES[rtype] + binascii.unhexlify(key) +
+                    self._value(rec["provenance"], out))
+        else:
+            body = _OTHER_RECORD + self._value(rec, out)
+        out.append(_LENGTH.pack(len(body)) + body)
+        return "".join(out)
+
+
+def make_encoder(journal_format):
+    if journal_format == "json":
+        return JsonEncoder()
+    if journal_format == "binary":
+        return BinaryEncoder()
+    raise RuntimeError("Invalid journal format '" + journal_format + "'")
+
+
+# Returns "json" or "binary" for an existing journal, or None if the journal
+# doesn't exist or is empty.
+def file_format(path):
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(MAGIC))
+    except IOError:
+        return None
+    if head == "":
+        return None
+    if head == MAGIC:
+        return "binary"
+    return "json"
+
+
+def _decode(data, pos, strings):
+    tag = data[pos]
+    pos += 1
+    if tag == "r":
+        index, pos = _read_varint(data, pos)
+        return strings[index], pos
+    if tag == "s":
+        size, pos = _read_varint(data, pos)
+        return data[pos:pos + size], pos + size
+    if tag == "m":
+        count, pos = _read_varint(data, pos)
+        rval = {}
+        for index in xrange(count):
+            key, pos = _decode(data, pos, strings)
+            rval[key], pos = _decode(data, pos, strings)
+        return rval, pos
+    if tag == "d":
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    if tag == "T":
+        return True, pos
+    if tag == "F":
+        return False, pos
+    if tag == "0":
+        return None, pos
+    if tag == "i":
+        return _read_varint(data, pos)
+    if tag == "-":
+        num, pos = _read_varint(data, pos)
+        return -num, pos
+    if tag == "l":
+        count, pos = _read_varint(data, pos)
+        rval = []
+        for index in xrange(count):
+            sub, pos = _decode(data, pos, strings)
+            rval.append(sub)
+        return rval, pos
+    raise RuntimeError("Corrupt journal value tag " + repr(tag))
+
+
+# Stream the raw records of a binary journal as (type, body, strings). String
+# records are handled here. A record cut short by a crash ends the journal,
+# end[0] is kept at the file offset right after the last complete record.
+def _binary_records(f, end):
+    f.read(len(MAGIC))
+    end[0] = len(MAGIC)
+    strings = []
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        size = _LENGTH.unpack(head)[0]
+        body = f.read(size)
+        if len(body) < size or size == 0:
+            return
+        end[0] += 4 + size
+        rtype = body[0]
+        if rtype == _STRING_RECORD:
+            strings.append(body[1:])
+        elif rtype == _RESET_RECORD:
+            # Records decoded later still refer to the old table.
+            strings = []
+        else:
+            yield rtype, body, strings
+
+
+# Stream the records of a JSON journal as dicts. Just like with binary
+# journals, a line cut short by a crash ends the journal.
+def _json_records(f, end):
+    end[0] = 0
+    for line in f:
+        if not line.endswith("\n"):
+            return
+        end[0] += len(line)
+        line = line.rstrip().encode('ascii', 'ignore')
+        yield json.loads(line)
+
+
+# Stream all complete records of a journal file as dicts, as they would look
+# in the JSON format. If given, end[0] is set to the file offset right after
+# the last complete record.
+def read_records(path, end=None):
+    if end is None:
+        end = [0]
+    if file_format(path) == "binary":
+        with open(path, "rb") as f:
+            for rtype, body, strings in _binary_records(f, end):
+                if rtype == _OTHER_RECORD:
+                    yield _decode(body, 1, strings)[0]
+                else:
+                    yield {"type": _KEYED_NAMES[rtype],
+                           "key": binascii.hexlify(body[1:33]),
+                           "provenance": _decode(body, 33, strings)[0]}
+    elif file_format(path) == "json":
+        with open(path, "r") as f:
+            for dat in _json_records(f, end):
+                yield dat
+
+
+# Replay a journal file, returning the provenance records of all jobs that
+# weren't finished yet, by job key, and the file offset right after the last
+# complete record. Anything beyond that offset was cut short by a crash and
+# must be truncated before appending to the journal. For binary journals
+# only the record type and key get looked at while streaming, the provenance
+# of jobs that turn out to be finished is never decoded.
+def replay(path):
+    journalinfo = {}
+    end = [0]
+    fmt = file_format(path)
+    if fmt == "json":
+        for dat in read_records(path, end):
+            dtype = dat["type"]
+            if dtype == "NEW":
+                journalinfo[dat["key"]] = [dat["provenance"]]
+            elif dtype == "UPD":
+                journalinfo[dat["key"]].append(dat["provenance"])
+            elif dtype == "FNL":
+                del journalinfo[dat["key"]]
+            elif dtype == "RPENT":
+                journalinfo[dat["key"]] = dat["provenance"]
+    elif fmt == "binary":
+        with open(path, "rb") as f:
+            for rtype, body, strings in _binary_records(f, end):
+                if rtype == "N" or rtype == "R":
+                    journalinfo[body[1:33]] = [(rtype, body, strings)]
+                elif rtype == "U":
+                    journalinfo[body[1:33]].append((rtype, body, strings))
+                elif rtype == "F":
+                    del journalinfo[body[1:33]]
+        for rawkey in journalinfo.keys():
+            records = []
+            for rtype, body, strings in journalinfo.pop(rawkey):
+                prov = _decode(body, 33, strings)[0]
+                if rtype == "R":
+                    records.extend(prov)
+                else:
+                    records.append(prov)
+            journalinfo[binascii.hexlify(rawkey)] = records
+    return (journalinfo, end[0])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import os
+    import anycast
+    path = "./test.journal"
+    for journal_format in ("json", "binary"):
+        print journal_format + ":"
+        for name in (path, path + "-previous"):
+            if os.path.exists(name):
+                os.unlink(name)
+        key = "ab" * 32
+        journal = anycast.JournalFile(path, journal_format=journal_format)
+        journal.record({"type": "NEW", "key": key,
+                        "provenance": {"actor": "kickstart", "time": 1.5}})
+        journal.record({"type": "UPD", "key": key,
+                        "provenance": {"actor": "exif", "active": True}})
+        journal.close()
+        # A crash in the middle of writing the last record.
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+        (journalinfo, validsize) = replay(path)
+        print journalinfo[key] == [{"actor": "kickstart", "time": 1.5}]
+        # Records written after the restart must survive the next one.
+        journal = anycast.JournalFile(path, journal_format=journal_format,
+                                      validsize=validsize)
+        journal.record({"type": "UPD", "key": key,
+                        "provenance": {"actor": "carver", "active": False}})
+        journal.close()
+        (journalinfo, validsize) = replay(path)
+        print journalinfo[key] == [{"actor": "kickstart", "time": 1.5},
+                                   {"actor": "carver", "active": False}]
+        print validsize == os.path.getsize(path)
+        os.unlink(path)
@@ -29,13 +29,20 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
 #
 import copy
+import sys
+import threading
+import traceback
+import rangeindex
+try:
+    import Queue as queue
+except ImportError:  # pragma: no cover
+    import queue
 
 
 try:
     from pyblake2 import blake2b
     ohash_algo = blake2b
 except ImportError:  # pragma: no cover
-    import sys
     print("")
     print("\033[93mERROR:\033[0m Pyblake2 module not installed.")
     print("Please install blake2 python module.")
@@ -54,6 +61,19 @@ except:  # pragma: no cover
     pass
 
 
+# Decorator for methods that need to hold the lock of their object.
+def _locked(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# A single read-only block of zeroes, sliced for hashing sparse data of any
+# size without allocating zero buffers.
+_ZEROES = memoryview(b"\0" * 1048576)
+
+
 # Opportunistic hashing state for a single fixed-size entity
 class _Opportunistic_Hash:
     def __init__(self, size):
@@ -66,11 +86,80 @@ class _Opportunistic_Hash:
         self.fullsize = size
         # If this is a new mutable entity, start off as clean sparse.
         self.cleansparse = True
+        # Hashes sharing our state for a prefix, by prefix size.
+        self.forks = {}
+        # The hash we share our state with for the first forkoffset bytes.
+        self.leader = None
+        self.forkoffset = 0
+
+    # Let an other hash, of data that is identical to ours for the first
+    # forkoffset bytes, share our hashing state untill we get there.
+    def add_follower(self, follower, forkoffset):
+        if forkoffset == self.offset:
+            follower.adopt(h=self._h.copy(), offset=self.offset)
+            return
+        follower.leader = self
+        follower.forkoffset = forkoffset
+        follower.offset = self.offset
+        self.forks.setdefault(forkoffset, []).append(follower)
+
+    def remove_follower(self, follower):
+        followers = self.forks[follower.forkoffset]
+        followers.remove(follower)
+        if len(followers) == 0:
+            del self.forks[follower.forkoffset]
+
+    # Hand a copy of our current state to all followers, we are going away.
+    def release_followers(self):
+        for forkoffset in self.forks:
+            for follower in self.forks[forkoffset]:
+                follower.adopt(h=self._h.copy(), offset=self.offset)
+        self.forks = {}
+
+    # Stop sharing the state of our leader and continue on our own.
+    def detach(self):
+        self.leader.remove_follower(follower=self)
+        self.adopt(h=self.leader._h.copy(), offset=self.leader.offset)
+
+    # Continue from a copy of the hashing state of our leader.
+    def adopt(self, h, offset):
+        self._h = h
+        self.offset = offset
+        self.leader = None
+        if self.offset > 0 and self.offset == self.fullsize:
+            self.done()
+
+    # Update the hashing state with data at our hashing offset, handing out
+    # copies of the state to followers as we pass their fork offsets.
+    def _update(self, data):
+        while len(self.forks) > 0:
+            forkoffset = min(self.forks)
+            if forkoffset > self.offset + len(data):
+                break
+            split = forkoffset - self.offset
+            self._h.update(data[:split])
+            self.offset = forkoffset
+            data = data[split:]
+            for follower in self.forks.pop(forkoffset):
+                follower.adopt(h=self._h.copy(), offset=forkoffset)
+        self._h.update(data)
+        self.offset += len(data)
+        self._sync_followers()
+
+    # Followers are where we are untill we reach their fork offset.
+    def _sync_followers(self):
+        for forkoffset in self.forks:
+            for follower in self.forks[forkoffset]:
+                follower.offset = self.offset
 
     # A sparse chunk
     def sparse(self, length, offset):
-        # Process as a chunk of read zeroes.
-        self.read_chunk(data=bytearray(length), offset=offset)
+        # Process as read zeroes, one block of zeroes at a time.
+        while length > 0 and offset <= self.offset and not self.isdone:
+            size = min(length, len(_ZEROES))
+            self.read_chunk(data=_ZEROES[:size], offset=offset)
+            offset += size
+            length -= size
 
     # Indicate that mutable entity won't be written to any more times.
     def freeze(self):
@@ -82,6 +171,9 @@ class _Opportunistic_Hash:
 
     # Process a piece of data written to offset.
     def written_chunk(self, data, offset):
+        if self.leader is not None:
+            # Our leader does the hashing for now.
+            return
         if offset < self.offset:
             # Something written before our current hashing offset. This means
             # hashed data changed and we need to start over.
@@ -91,33 +183,29 @@ class _Opportunistic_Hash:
             self.cleansparse = False  # We can no longer assume we are a
             #                           cleanly sparse file.
             self.result = "INCOMPLETE-OPPORTUNISTIC_HASHING"
+            self._sync_followers()
         # If writing a sparse file in sequence, we can forward our hashing
         # by assuming the file is meant to become sparse.
         if (offset > self.offset) and self.cleansparse:
             # There is a gap we can assume sparse.
-            difference = offset - self.offset
-            times = difference / 65536
-            for i in range(0, times):
-                self.sparse(length=65536, offset=self.offset)
-            self.sparse(length=difference % 65536, offset=self.offset)
+            self.sparse(length=offset - self.offset, offset=self.offset)
         # If the offset of the data alligns with the hashing offset, update
         # the hash with our new data.
         if offset == self.offset:
-            self._h.update(data)
-            self.offset += len(data)
+            self._update(data)
         # If the offset equals the size, than complete the hashing process.
         if self.offset > 0 and self.offset == self.fullsize:
             self.done()
 
     # Process a piece of data read from offset.
     def read_chunk(self, data, offset):
-        if ((not self.isdone) and offset <= self.offset and
+        if ((not self.isdone) and self.leader is None and
+           offset <= self.offset and
            offset+len(data) > self.offset):
             # Fragment overlaps offset;Find part that we didn't process yet
             start = self.offset - offset
             datasegment = data[start:]
-            self._h.update(datasegment)
-            self.offset += len(datasegment)
+            self._update(datasegment)
             # If the offset equals size,than complete the hashing process.
             if self.offset > 0 and self.offset == self.fullsize:
                 self.done()
@@ -155,7 +243,7 @@ class _OH_Entity:
         if ((not self.ohash.isdone) and
            (parentoffset <= roi[0] or writemode) and
            parentoffset < roi[1] and
-           parentendoffset > roi[0]):
+           parentendoffset >= roi[0]):
             childoffset = 0  # Start of with a child offset of zero.
             working = False  # Marks if we are working on the hash.
             updated = False  # This indicates that the hash has been updated
@@ -232,6 +320,29 @@ class _OH_Entity:
     def hashing_offset(self):
         return self.ohash.offset
 
+    # Update our range-of-interest and log our result if our leader just
+    # handed us the hashing state.
+    def adopted(self):
+        self.hash_sparse()
+        self.roi = self.ent.getroi(from_offset=self.ohash.offset)
+        if self.ohash.isdone:
+            self.log.write(str(self.ent) + ":" + self.ohash.result + "\n")
+
+    # Hash the sparse run at our hashing offset, up to the next real data.
+    # Just like process_parent_chunk does for sparse right after data it just
+    # hashed, as a state handed to us may end right before or inside of a
+    # sparse run that no read will ever hit.
+    def hash_sparse(self):
+        childoffset = 0
+        for fragment in self.ent.fragments:
+            end = childoffset + fragment.size
+            if end > self.ohash.offset:
+                if not fragment.issparse():
+                    return
+                self.ohash.sparse(length=end - self.ohash.offset,
+                                  offset=self.ohash.offset)
+            childoffset = end
+
     # Get the opportunistic hasing result.
     def hashing_result(self):
         return self.ohash.result
@@ -240,6 +351,34 @@ class _OH_Entity:
     def hashing_isdone(self):
         return self.ohash.isdone
 
+    # For background hashing: get the parent offset and size (at most
+    # maxsize) of the un-hashed data at the hashing offset. If the entity is
+    # sparse there, hash the zeroes right away and return None.
+    def next_unhashed(self, maxsize):
+        childoffset = 0
+        for fragment in self.ent.fragments:
+            if childoffset + fragment.size > self.ohash.offset:
+                start = self.ohash.offset - childoffset
+                size = min(fragment.size - start, maxsize)
+                if not fragment.issparse():
+                    return (fragment.offset + start, size)
+                self.catch_up(data=None, size=size)
+                return None
+            childoffset += fragment.size
+        return None
+
+    # For background hashing: hash the data found by next_unhashed, or size
+    # zeroes if data is None.
+    def catch_up(self, data, size):
+        wasdone = self.ohash.isdone
+        if data is None:
+            self.ohash.sparse(length=size, offset=self.ohash.offset)
+        else:
+            self.ohash.read_chunk(data=data, offset=self.ohash.offset)
+        self.roi = self.ent.getroi(from_offset=self.ohash.offset)
+        if self.ohash.isdone and (not wasdone):
+            self.log.write(str(self.ent) + ":" + self.ohash.result + "\n")
+
     # Indicate that the mutable entity is now frozen and no more writes will
     # occur.
     def freeze(self):
@@ -250,6 +389,37 @@ class _OH_Entity:
             self.log.write(str(self.ent) + ":" + self.ohash.result + "\n")
 
 
+# Size of the identical prefix of two entities, the number of leading bytes
+# that map to the same archive data (or to sparse data in both).
+def _common_prefix(ent1, ent2):
+    frags1 = ent1.fragments
+    frags2 = ent2.fragments
+    index1 = 0
+    index2 = 0
+    pos1 = 0  # Position within the current fragment of ent1.
+    pos2 = 0  # Position within the current fragment of ent2.
+    prefix = 0
+    while index1 < len(frags1) and index2 < len(frags2):
+        frag1 = frags1[index1]
+        frag2 = frags2[index2]
+        if frag1.issparse() != frag2.issparse():
+            break
+        if (not frag1.issparse() and
+           frag1.offset + pos1 != frag2.offset + pos2):
+            break
+        step = min(frag1.size - pos1, frag2.size - pos2)
+        prefix += step
+        pos1 += step
+        pos2 += step
+        if pos1 == frag1.size:
+            index1 += 1
+            pos1 = 0
+        if pos2 == frag2.size:
+            index2 += 1
+            pos2 = 0
+    return prefix
+
+
 # Collection of repository CarvPath's still active in MattockFS and possible
 # candidates for opportunistic hashing.
 class OpportunisticHashCollection:
@@ -259,47 +429,369 @@ class OpportunisticHashCollection:
         #                      opportunistic hashing candidates,
         self.log = open(ohash_log, "a", 0)  # Open a log file to keep track of
         #                                     successfull opportunistic hashing
+        # Lock for using the collection from multiple FUSE threads.
+        self.lock = threading.RLock()
+        # Index on the start of the read range-of-interest of all unfinished
+        # candidates, and one on their (static) write range-of-interest.
+        self.readindex = rangeindex.RangeIndex()
+        self.writeindex = rangeindex.RangeIndex()
+        # Carvpaths of mutable data that may still get written to.
+        self.mutables = set()
+        # Candidates by archive offset of their first fragment, for finding
+        # candidates with an identical prefix.
+        self.byfirst = {}
+        # Candidates sharing the hashing state of an other candidate for
+        # their prefix, and the reverse mapping.
+        self.followers = {}
+        self.leaders = {}
+
+    # Let a new candidate share the hashing state of the existing candidate
+    # with the longest identical prefix, as long as that one isn't past it.
+    def _share(self, carvpath):
+        ohe = self.ohash[carvpath]
+        if (len(ohe.ent.fragments) == 0 or ohe.ent.fragments[0].issparse() or
+           carvpath in self.mutables):
+            return
+        first = ohe.ent.fragments[0].offset
+        best = None
+        bestprefix = 0
+        for other in self.byfirst.get(first, ()):
+            otherohe = self.ohash[other]
+            if (other in self.mutables or other in self.leaders or
+               otherohe.hashing_isdone()):
+                continue
+            prefix = _common_prefix(ohe.ent, otherohe.ent)
+            if prefix > bestprefix and otherohe.ohash.offset <= prefix:
+                best = other
+                bestprefix = prefix
+        self.byfirst.setdefault(first, set()).add(carvpath)
+        if best is not None:
+            self.ohash[best].ohash.add_follower(follower=ohe.ohash,
+                                                forkoffset=bestprefix)
+            if ohe.ohash.leader is None:
+                # Leader was exactly at the fork, state copied right away.
+                ohe.adopted()
+            else:
+                self.followers.setdefault(best, set()).add(carvpath)
+                self.leaders[carvpath] = best
+
+    def _drop_leader(self, carvpath):
+        leader = self.leaders.pop(carvpath)
+        self.followers[leader].discard(carvpath)
+        if len(self.followers[leader]) == 0:
+            del self.followers[leader]
+
+    # Stop administering a follower as such, its leader handed it a state.
+    def _unfollow(self, carvpath):
+        self._drop_leader(carvpath)
+        self.ohash[carvpath].adopted()
+        self._reindex(carvpath)
+
+    # Update the indices for a candidate after its hashing state changed.
+    def _reindex(self, carvpath):
+        ohe = self.ohash[carvpath]
+        if carvpath in self.followers:
+            for follower in list(self.followers[carvpath]):
+                if self.ohash[follower].ohash.leader is None:
+                    # We passed its fork offset, it's on its own now.
+                    self._unfollow(follower)
+                else:
+                    # It moved along with us.
+                    fohe = self.ohash[follower]
+                    fohe.roi = fohe.ent.getroi(from_offset=fohe.ohash.offset)
+                    self._reindex(follower)
+        if ohe.hashing_isdone():
+            # Finished candidates don't need any more data.
+            self.readindex.remove(carvpath)
+            self.writeindex.remove(carvpath)
+            return
+        # A None start means no data can be read for the candidate
+        # (sparse at the hashing offset).
+        if ohe.roi[0] is not None:
+            self.readindex.add(carvpath, ohe.roi[0], ohe.roi[1])
+        else:
+            self.readindex.remove(carvpath)
 
     # Add a new carvpath to the collection.
+    @_locked
     def add_carvpath(self, carvpath):
         # Parse the carvpath.
         ent = self.context.parse(path=carvpath)
         # Create a new opportunistic hashing candidate.
-        self.ohash[carvpath] = _OH_Entity(entity=ent, log=self.log)
+        ohe = _OH_Entity(entity=ent, log=self.log)
+        self.ohash[carvpath] = ohe
+        # A None start for writing means the entity starts off sparse; any
+        # write before its end may be of interest.
+        self.writeindex.remove(carvpath)
+        if ohe.writeroi[1] is not None:
+            start = ohe.writeroi[0]
+            if start is None:
+                start = 0
+            self.writeindex.add(carvpath, start, ohe.writeroi[1])
+        self._share(carvpath)
+        self._reindex(carvpath)
 
     # Drop a candidate from the collection.
+    @_locked
     def remove_carvpath(self, carvpath):
+        ohe = self.ohash[carvpath]
+        if carvpath in self.followers:
+            # Followers continue from our current state.
+            ohe.ohash.release_followers()
+            for follower in list(self.followers[carvpath]):
+                self._unfollow(follower)
+        if carvpath in self.leaders:
+            ohe.ohash.leader.remove_follower(follower=ohe.ohash)
+            self._drop_leader(carvpath)
+        if len(ohe.ent.fragments) > 0 and not ohe.ent.fragments[0].issparse():
+            first = ohe.ent.fragments[0].offset
+            if first in self.byfirst:
+                self.byfirst[first].discard(carvpath)
+                if len(self.byfirst[first]) == 0:
+                    del self.byfirst[first]
         del self.ohash[carvpath]
+        self.mutables.discard(carvpath)
+        self.readindex.remove(carvpath)
+        self.writeindex.remove(carvpath)
 
     # Process data written to the underlying data archive.
+    @_locked
     def lowlevel_written_data(self, offset, data):
-        for carvpath in self.ohash.keys():
+        # Only candidates with a write range-of-interest overlapping the data.
+        candidates = self.writeindex.overlapping(offset,
+                                                 offset + len(data) - 1)
+        # Written data may change a follower beyond its shared prefix, so
+        # followers continue on their own before anything gets processed.
+        for carvpath in candidates:
+            if carvpath in self.leaders:
+                self.ohash[carvpath].ohash.detach()
+                self._drop_leader(carvpath)
+        for carvpath in candidates:
             self.ohash[carvpath].written_parent_chunk(data=data,
                                                       parentoffset=offset)
+            self._reindex(carvpath)
 
     # Process data read from the underlying data archive.
+    @_locked
     def lowlevel_read_data(self, offset, data):
-        for carvpath in self.ohash.keys():
-            self.ohash[carvpath].read_parent_chunk(data=data,
-                                                   parentoffset=offset)
+        last = offset + len(data) - 1
+        # Only candidates with their next unhashed byte within the data.
+        candidates = self.readindex.starting_in(offset, last)
+        # Leaders go first. A follower only needs the data if its leader
+        # didn't use it, in which case it continues on its own.
+        for carvpath in sorted(candidates, key=lambda cp: cp in self.leaders):
+            ohe = self.ohash[carvpath]
+            if carvpath in self.leaders:
+                if ohe.roi[0] is None or not offset <= ohe.roi[0] <= last:
+                    continue
+                ohe.ohash.detach()
+                self._drop_leader(carvpath)
+            ohe.read_parent_chunk(data=data, parentoffset=offset)
+            self._reindex(carvpath)
 
     # Query if hashing for a given CarvPath has fully completed.
+    @_locked
     def hashing_isdone(self, carvpath):
         return self.ohash[carvpath].hashing_isdone()
 
     # Get the hashing result for a carvpath
+    @_locked
     def hashing_value(self, carvpath):
         return self.ohash[carvpath].hashing_result()
 
     # Get the offset within the CarvPath of data that has not yet been
     # opportunistically hashed.
+    @_locked
     def hashing_offset(self, carvpath):
         return self.ohash[carvpath].hashing_offset()
 
+    # Same as hashing_offset, but without waiting for the lock or for any
+    # queued updates, and zero for carvpaths not added yet. Meant for job
+    # selection, where an offset that is a bit behind does no harm. Reading
+    # a single attribute needs no lock.
+    def current_hashing_offset(self, carvpath):
+        ohe = self.ohash.get(carvpath)
+        if ohe is None:
+            return 0
+        return ohe.hashing_offset()
+
     # Indicate that a mutable entity has just been frozen and no more writes
     # shall occur.
+    @_locked
     def freeze(self, carvpath):
+        if carvpath in self.leaders:
+            # Freezing may hash the rest as sparse, on our own.
+            self.ohash[carvpath].ohash.detach()
+            self._drop_leader(carvpath)
         self.ohash[carvpath].freeze()
+        self.mutables.discard(carvpath)
+        self._reindex(carvpath)
+
+    # Mark a newly allocated carvpath as mutable. Background hashing leaves
+    # it alone untill it gets frozen.
+    @_locked
+    def add_mutable(self, carvpath):
+        self.mutables.add(carvpath)
+
+    # For background hashing: pick the unfinished candidate closest to
+    # completion, not counting mutables and the carvpaths in exclude. Returns
+    # a (carvpath, offset, size, hashing offset) tuple for the archive data
+    # to read next, or None if there is nothing to hash.
+    @_locked
+    def catch_up_chunk(self, maxsize, exclude):
+        # Candidates that turned out to have nothing to hash.
+        stalled = set()
+        while True:
+            best = None
+            for carvpath in self.ohash:
+                ohe = self.ohash[carvpath]
+                # Empty carvpaths (like the S0 of kickstart jobs) never
+                # complete and have nothing to hash.
+                if (ohe.hashing_isdone() or carvpath in self.mutables or
+                   carvpath in self.leaders or carvpath in exclude or
+                   carvpath in stalled or
+                   ohe.hashing_offset() >= ohe.ent.totalsize):
+                    continue
+                remaining = ohe.ent.totalsize - ohe.hashing_offset()
+                if best is None or remaining < bestremaining:
+                    best = carvpath
+                    bestremaining = remaining
+            if best is None:
+                return None
+            ohe = self.ohash[best]
+            hashoffset = ohe.hashing_offset()
+            chunk = ohe.next_unhashed(maxsize=maxsize)
+            self._reindex(best)
+            if chunk is not None:
+                return (best, chunk[0], chunk[1], ohe.hashing_offset())
+            if ohe.hashing_offset() == hashoffset:
+                # No progress, don't pick it again.
+                stalled.add(best)
+
+    # For background hashing: process the data for a chunk returned by
+    # catch_up_chunk, unless the candidate is gone or progressed meanwhile.
+    @_locked
+    def catch_up_data(self, carvpath, hashoffset, data):
+        if (carvpath in self.ohash and
+           self.ohash[carvpath].hashing_offset() == hashoffset):
+            self.ohash[carvpath].catch_up(data=data, size=len(data))
+            self._reindex(carvpath)
+
+# Offloads all work for an OpportunisticHashCollection to a dedicated hashing
+# thread, so reads and writes no longer wait for hashing. All updates go
+# through a single queue in the order they were made, so the collection (and
+# its log) ends up exactly the same as when used directly. Queries wait for
+# the updates queued before them to be processed first, but not for any
+# queued later on. The queue is bounded, if hashing falls behind too far,
+# updates block untill it catches up. Note that pyblake2 holds the GIL while
+# hashing, so this only takes the hashing off the FUSE threads, it doesn't
+# let hashing run in parallel with other Python code.
+class OffloadedHashCollection:
+    def __init__(self, collection, maxqueue=256):
+        self.col = collection
+        self.queue = queue.Queue(maxsize=maxqueue)
+        # Number of updates queued and number of those processed.
+        self.queued = 0
+        self.processed = 0
+        self.putlock = threading.Lock()
+        self.progress = threading.Condition(threading.Lock())
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            (method, kwargs) = self.queue.get()
+            if method is None:
+                return
+            try:
+                method(**kwargs)
+            except:
+                # No caller to raise to, just report.
+                traceback.print_exc(file=sys.stderr)
+            with self.progress:
+                self.processed += 1
+                self.progress.notify_all()
+
+    def _put(self, method, kwargs):
+        if self.closed:
+            method(**kwargs)
+        else:
+            # Updates get counted in queue order.
+            with self.putlock:
+                self.queue.put((method, kwargs))
+                self.queued += 1
+
+    # Wait for all updates queued so far to be processed. Updates queued
+    # while waiting don't count, so continuous reads can't starve us.
+    def drain(self):
+        if not self.closed:
+            target = self.queued
+            with self.progress:
+                while self.processed < target and not self.closed:
+                    self.progress.wait()
+
+    # Process all queued updates and stop the hashing thread. Any later
+    # updates are processed right away.
+    def close(self):
+        if not self.closed:
+            self.queue.put((None, None))
+            self.thread.join()
+            with self.progress:
+                self.closed = True
+                self.progress.notify_all()
+
+    # The candidate map of the collection, once up to date.
+    @property
+    def ohash(self):
+        self.drain()
+        return self.col.ohash
+
+    def add_carvpath(self, carvpath):
+        self._put(self.col.add_carvpath, {"carvpath": carvpath})
+
+    def remove_carvpath(self, carvpath):
+        self._put(self.col.remove_carvpath, {"carvpath": carvpath})
+
+    def lowlevel_written_data(self, offset, data):
+        self._put(self.col.lowlevel_written_data,
+                  {"offset": offset, "data": data})
+
+    def lowlevel_read_data(self, offset, data):
+        self._put(self.col.lowlevel_read_data,
+                  {"offset": offset, "data": data})
+
+    def freeze(self, carvpath):
+        self._put(self.col.freeze, {"carvpath": carvpath})
+
+    def add_mutable(self, carvpath):
+        self._put(self.col.add_mutable, {"carvpath": carvpath})
+
+    def hashing_isdone(self, carvpath):
+        self.drain()
+        return self.col.hashing_isdone(carvpath=carvpath)
+
+    def hashing_value(self, carvpath):
+        self.drain()
+        return self.col.hashing_value(carvpath=carvpath)
+
+    def hashing_offset(self, carvpath):
+        self.drain()
+        return self.col.hashing_offset(carvpath=carvpath)
+
+    # Doesn't wait for anything, see the collection.
+    def current_hashing_offset(self, carvpath):
+        return self.col.current_hashing_offset(carvpath=carvpath)
+
+    # Background hashing works on the collection directly.
+    def catch_up_chunk(self, maxsize, exclude):
+        return self.col.catch_up_chunk(maxsize=maxsize, exclude=exclude)
+
+    def catch_up_data(self, carvpath, hashoffset, data):
+        self.col.catch_up_data(carvpath=carvpath, hashoffset=hashoffset,
+                               data=data)
+
 
 if __name__ == "__main__":  # pragma: no cover
     import carvpath
@@ -327,3 +819,24 @@ if __name__ == "__main__":  # pragma: no cover
     print ohc.hashing_isdone("10+5"), ohc.hashing_isdone("13+5")
     print ohc.hashing_offset("10+5"), ohc.hashing_offset("13+5")
     print ohc.hashing_value("10+5"), ohc.hashing_value("13+5")
+    print
+    print "Shared prefix ending inside of a sparse run"
+    ohc.add_carvpath("100+10_S5_200+10")
+    ohc.add_carvpath("100+10_S20")
+    ohc.lowlevel_read_data(100, b"0123456789")
+    print ohc.hashing_isdone("100+10_S5_200+10"), ohc.hashing_isdone("100+10_S20")
+    print ohc.hashing_offset("100+10_S5_200+10"), ohc.hashing_offset("100+10_S20")
+    print ohc.hashing_value("100+10_S20") == ohash_algo(
+      b"0123456789" + b"\0" * 20, digest_size=32).hexdigest()
+    print
+    print "Shared prefix ending right before a sparse run"
+    ohc.add_carvpath("300+10_400+10")
+    ohc.add_carvpath("300+10_S7")
+    ohc.lowlevel_read_data(300, b"0123456789")
+    print ohc.hashing_isdone("300+10_400+10"), ohc.hashing_isdone("300+10_S7")
+    print ohc.hashing_offset("300+10_400+10"), ohc.hashing_offset("300+10_S7")
+    print
+    print "Background catch-up with an empty candidate"
+    ohc2 = OpportunisticHashCollection(context, "./test.log")
+    ohc2.add_carvpath("S0")
+    print ohc2.catch_up_chunk(maxsize=65536, exclude=set())
@@ -71,8 +71,7 @@ class ProvenanceLog:
             # Create a journal log record
             journal_rec = {"type": "NEW", "key": self.key, "provenance": rec}
             # Write the record synchonously to the journal.
-            self.journal.write(json.dumps(journal_rec,sort_keys=True))
-            self.journal.write("\n")
+            self.journal.record(journal_rec)
     def __del__(self):
         # When the ProvenanceLog object is deleted, create one last record.
         rec = {}
@@ -84,11 +83,9 @@ class ProvenanceLog:
         # Create a journal record.
         journal_rec = {"type": "FNL", "key": key, "provenance" : rec}
         # Write it to the journal.
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.record(journal_rec)
         # Write the full provenance log to the provenance logging file.
-        self.provenance.write(json.dumps(self.log,sort_keys=True))
-        self.provenance.write("\n")
+        self.provenance.write(json.dumps(self.log,sort_keys=True) + "\n")
 
     def __call__(self, jobid, actor, router_state="", restore=False,command=None, user=None):
         newobj = {"jobid": jobid,
@@ -111,8 +108,7 @@ class ProvenanceLog:
                            "key": key,
                            "provenance": newobj}
             # And write it to the jounal log.
-            self.journal.write(json.dumps(journal_rec,sort_keys=True))
-            self.journal.write("\n")
+            self.journal.record(journal_rec)
     def accept(self,actor,command,user):
         newobj = {"actor": actor,
                   "time" : time.time(),
@@ -123,8 +119,7 @@ class ProvenanceLog:
         journal_rec = {"type" : "UPD",
                        "key"  : self.key,
                        "provenance" : newobj }
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.record(journal_rec)
     def restorepoint(self):
         # Retreive the unique key to use in the journal.
         key = self.key
@@ -133,7 +128,6 @@ class ProvenanceLog:
                        "key": key,
                        "provenance": self.log}
         # And write it to the jounal log.
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.record(journal_rec)
 
 
@@ -42,6 +42,7 @@ import sys
 import copy
 import os
 import redislongpathmap as longpathmap
+import sqlitelongpathmap
 import pwd
 import json
 
@@ -235,7 +236,9 @@ class TopCtl:
     def listxattr(self):  # pragma: no cover
         return ["user.fadvise_status",
                 "user.full_archive",
-                "user.add_longpath"]
+                "user.add_longpath",
+                "user.parse_cache_status",
+                "user.sortkey_cache_status"]
 
     def getxattr(self, name, size):
         if name == "user.fadvise_status":
@@ -247,11 +250,21 @@ class TopCtl:
             return "carvpath/" + str(self.rep.top.topentity) + ".raw"
         if name == "user.add_longpath":
             return ""
+        if name == "user.parse_cache_status":
+            # Get carvpath parse cache hits, misses and entry count.
+            return ";".join(map(lambda x: str(x),
+                                self.context.cache_info()))
+        if name == "user.sortkey_cache_status":
+            # Get job select sort value cache hits and misses per letter.
+            return ";".join(map(lambda x: ":".join(map(str, x)),
+                                self.rep.stack.sortkey_cache_info()))
         return -errno.ENODATA
 
     def setxattr(self, name, val):  # pragma: no cover
         if name in ("user.fadvise_status",
-                    "user.full_archive"):
+                    "user.full_archive",
+                    "user.parse_cache_status",
+                    "user.sortkey_cache_status"):
             return -errno.EPERM
         if name == "user.add_longpath":
             val = val.split("carvpath/")[-1].split(".")[0]
@@ -405,11 +418,17 @@ class WorkerCtl:
             return ["user.job_select_policy",
                     "user.actor_select_policy",
                     "user.unregister",
-                    "user.accept_job"]
+                    "user.accept_timeout",
+                    "user.accept_batch",
+                    "user.accept_job",
+                    "user.accept_jobs"]
         else:
             return ["user.job_select_policy",
                     "user.unregister",
-                    "user.accept_job"]
+                    "user.accept_timeout",
+                    "user.accept_batch",
+                    "user.accept_job",
+                    "user.accept_jobs"]
 
     def getxattr(self, name, size):  # pragma: no cover
         if name == "user.job_select_policy":
@@ -421,6 +440,10 @@ class WorkerCtl:
                 return -errno.ENODATA
         if name == "user.unregister":
             return "0"
+        if name == "user.accept_timeout":
+            return str(self.worker.accept_timeout)
+        if name == "user.accept_batch":
+            return str(self.worker.accept_batch)
         if name == "user.accept_job":
             if size == 0:
                 # Don't accidently accept jobs with listxattr.
@@ -433,6 +456,18 @@ class WorkerCtl:
                     return -errno.ENODATA
                 self.tick()
                 return "job/" + job + ".ctl"
+        if name == "user.accept_jobs":
+            if size == 0:
+                # Room for a newline separated full batch of job paths.
+                return 78 * self.worker.accept_batch
+            else:
+                # Accept up to accept_batch jobs at once.
+                jobs = self.worker.accept_jobs(count=self.worker.accept_batch)
+                if len(jobs) == 0:
+                    return -errno.ENODATA
+                for job in jobs:
+                    self.tick()
+                return "\n".join(["job/" + job + ".ctl" for job in jobs])
         return -errno.ENODATA
 
     def setxattr(self, name, val):
@@ -459,7 +494,27 @@ class WorkerCtl:
                 # to process exit!
                 self.worker.unregister()
             return 0
-        if name == "user.accept_job":  # pragma: no cover
+        if name == "user.accept_timeout":
+            # Milliseconds that accept_job may wait for a job to arrive.
+            try:
+                timeout = int(val)
+            except ValueError:
+                return -errno.EINVAL
+            if timeout < 0:
+                return -errno.EINVAL
+            self.worker.accept_timeout = timeout
+            return 0
+        if name == "user.accept_batch":
+            # Number of jobs handed out by accept_jobs.
+            try:
+                batch = int(val)
+            except ValueError:
+                return -errno.EINVAL
+            if batch < 1 or batch > 256:
+                return -errno.EINVAL
+            self.worker.accept_batch = batch
+            return 0
+        if name in ("user.accept_job", "user.accept_jobs"):  # pragma: no cover
             return -errno.EPERM
         return -errno.ENODATA
 
@@ -485,6 +540,7 @@ class JobCtl:
     def listxattr(self):  # pragma: no cover
         return ["user.routing_info",
                 "user.submit_child",
+                "user.submit_children",
                 "user.allocate_mutable",
                 "user.frozen_mutable",
                 "user.current_mutable",
@@ -500,7 +556,8 @@ class JobCtl:
             print self.job.mime_type
             return (self.job.actorname + ";" + self.job.router_state +
                     ";" + self.job.mime_type)
-        if name == "user.submit_child":  # pragma: no cover
+        if name in ("user.submit_child",
+                    "user.submit_children"):  # pragma: no cover
             return ""
         if name == "user.allocate_mutable":  # pragma: no cover
             return ""
@@ -537,11 +594,26 @@ class JobCtl:
             return 0
         if name == "user.submit_child":
             parts = val.split(";")
-            if len(parts) == 5:
-                # carvpath, nexthop, routerstate, mime, ext
-                self.job.submit_child(carvpath=parts[0], nexthop=parts[1],
-                                      routerstate=parts[2], mimetype=parts[3],
-                                      extension=parts[4])
+            if len(parts) != 5:
+                return -errno.EINVAL
+            # carvpath, nexthop, routerstate, mime, ext
+            self.job.submit_child(carvpath=parts[0], nexthop=parts[1],
+                                  routerstate=parts[2], mimetype=parts[3],
+                                  extension=parts[4])
+            self.tick()
+            return 0
+        if name == "user.submit_children":
+            # One submission per line, in the same format as above. Nothing
+            # gets submitted if any of the lines is invalid.
+            lines = val.split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            children = [line.split(";") for line in lines]
+            for parts in children:
+                if len(parts) != 5:
+                    return -errno.EINVAL
+            self.job.submit_children(children=children)
+            for child in children:
                 self.tick()
             return 0
         if name == "user.allocate_mutable":
@@ -729,11 +801,15 @@ class EtcLink:
 # The actual FUSE MattockFS file-system.
 class MattockFS(fuse.Fuse):
     def __init__(self, dash_s_do, version, usage, dd, lpdb, journal,
-                 provenance_log, ohash_log, refcount_log):
+                 provenance_log, ohash_log, refcount_log, mmap_reads=False,
+                 background_hashing=False, hashing_offload=False,
+                 journal_durability="write", journal_flush_interval=50,
+                 journal_format="json"):
         super(MattockFS, self).__init__(version=version, usage=usage,
                                         dash_s_do=dash_s_do)
         self.longpathdb = lpdb
-        self.context = carvpath.Context(lpmap=self.longpathdb)
+        self.context = carvpath.Context(lpmap=self.longpathdb,
+                                        cachesize=4096)
         self.topdir = TopDir()
         self.nolistdir = NoList()
         # Regular expressions for select policies.
@@ -744,14 +820,20 @@ class MattockFS(fuse.Fuse):
             reppath=self.archive_dd,
             context=self.context,
             ohash_log=ohash_log,
-            refcount_log=refcount_log)
+            refcount_log=refcount_log,
+            mmap_reads=mmap_reads,
+            background_hashing=background_hashing,
+            hashing_offload=hashing_offload)
         self.ms = anycast.Actors(
             rep=self.rep,
             journal=journal,
             provenance=provenance_log,
             context=self.context,
             stack=self.rep.stack,
-            col=self.rep.col)
+            col=self.rep.col,
+            journal_durability=journal_durability,
+            journal_flush_interval=journal_flush_interval,
+            journal_format=journal_format)
         self.etcdir = EtcDir()
         self.topctl = TopCtl(rep=self.rep, context=self.context)
         self.actordir = ActorDir(actors=self.ms)
@@ -854,9 +936,23 @@ class MattockFS(fuse.Fuse):
             return NoEnt()
         return NoEnt()
 
+    # Forward a node operation to the parsepath result. Only nodes under
+    # $MP/carvpath/ are pure data-plane nodes that never touch the anycast
+    # state, all other operations get serialised on the Actors lock.
+    def forward(self, path, operation, *args):
+        if path.startswith("/carvpath/"):
+            return getattr(self.parsepath(path), operation)(*args)
+        with self.ms.lock:
+            # All journal records of a single request go out in one write.
+            self.ms.begin_batch()
+            try:
+                return getattr(self.parsepath(path), operation)(*args)
+            finally:
+                self.ms.end_batch()
+
     # Forward getattr to parsepath result.
     def getattr(self, path):
-        return self.parsepath(path).getattr()
+        return self.forward(path, "getattr")
 
     # Do nothing on setattr.
     def setattr(self, path, hmm):
@@ -864,11 +960,11 @@ class MattockFS(fuse.Fuse):
 
     # Forward
     def opendir(self, path):
-        return self.parsepath(path).opendir()
+        return self.forward(path, "opendir")
 
-    # Forward
+    # Forward, listing the directory before giving up the lock.
     def readdir(self, path, offset):
-        return self.parsepath(path).readdir()
+        return list(self.forward(path, "readdir"))
 
     # Do nothing on releasedir.
     def releasedir(self, path):
@@ -876,14 +972,14 @@ class MattockFS(fuse.Fuse):
 
     # Forward
     def readlink(self, path):
-        return self.parsepath(path).readlink()
+        return self.forward(path, "readlink")
 
     # Forward
     def listxattr(self, path, huh):
-        return self.parsepath(path).listxattr()
+        return self.forward(path, "listxattr")
 
     def getxattr(self, path, name, size):
-        rval = self.parsepath(path).getxattr(name, size)
+        rval = self.forward(path, "getxattr", name, size)
         if isinstance(rval, int) and rval < 0:
             return rval
         if size == 0:
@@ -895,14 +991,14 @@ class MattockFS(fuse.Fuse):
 
     # Forward
     def setxattr(self, path, name, val, more):
-        return self.parsepath(path).setxattr(name, val)
+        return self.forward(path, "setxattr", name, val)
 
     def main(self, args=None):
         fuse.Fuse.main(self, args)
 
     # Forward
     def open(self, path, flags):
-        rval = self.parsepath(path).open(flags, path)
+        rval = self.forward(path, "open", flags, path)
         return rval
 
     # Forward open file operations to repository.
@@ -924,6 +1020,33 @@ class MattockFS(fuse.Fuse):
     def flush(self, path):
         self.rep.flush()
 
+    # Finish hashing and make sure all new long path digests end up in the
+    # long path database before we go.
+    def fsdestroy(self):
+        self.rep.finish_hashing()
+        self.longpathdb.flush()
+        self.ms.flush()
+
+
+# Read the MattockFS config file, if any.
+def _load_config():
+    try:
+        with open("/etc/mattockfs.json") as config_file:
+            return json.loads(config_file.read())
+    except IOError:
+        return {}
+
+
+# Create the long path database as configured with "longpath_store".
+def _make_longpathmap(conf, mattockdir):
+    store = conf.get("longpath_store", "redis")
+    if store == "sqlite":
+        lpmap = sqlitelongpathmap.LongPathMap(
+                  dbpath=mattockdir + "/archive/longpath.sqlite")
+    else:
+        lpmap = longpathmap.LongPathMap()
+    return longpathmap.CachingLongPathMap(lpmap=lpmap)
+
 
 # File-system startup
 def run(mattockitem="0"):
@@ -970,19 +1093,34 @@ def run(mattockitem="0"):
     # Mountpoint.
     mp = mattockdir + "/mnt/" + mattockitem
     sys.argv.append(mp)
+    conf = _load_config()
     mattockfs = MattockFS(
                   version='%prog ' + '0.3.0',
                   usage='Mattock filesystem ' + fuse.Fuse.fusage,
                   dash_s_do='setsingle',
                   dd=dd,
-                  lpdb=longpathmap.LongPathMap(),
+                  lpdb=_make_longpathmap(conf, mattockdir),
                   journal=journal,
                   provenance_log=provenance_log,
                   ohash_log=ohash_log,
-                  refcount_log=refcount_log)
+                  refcount_log=refcount_log,
+                  mmap_reads=conf.get("mmap_reads", False),
+                  background_hashing=conf.get("background_hashing", False),
+                  hashing_offload=conf.get("hashing_offload", False),
+                  journal_durability=conf.get("journal_durability", "write"),
+                  journal_flush_interval=conf.get("journal_flush_interval",
+                                                  50),
+                  journal_format=conf.get("journal_format", "json"))
     mattockfs.parse(errex=1)
     mattockfs.flags = 0
-    mattockfs.multithreaded = 0
+    # Opt-in multithreaded mode, reads and writes of carvpath data then no
+    # longer wait for each other or for the control plane.
+    if conf.get("multithreaded", False):
+        mattockfs.multithreaded = 1
+        # Workers may then also wait for jobs in accept_job.
+        mattockfs.ms.blocking_accept = True
+    else:
+        mattockfs.multithreaded = 0
     # Actually run the file system.
     mattockfs.main()
 
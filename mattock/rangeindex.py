@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# Copyright (c) 2015, Rob J Meijer.
+# Copyright (c) 2015, University College Dublin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the <organization>.
+# 4. Neither the name of the <organization> nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY <COPYRIGHT HOLDER> ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
+#
+# Sorted index of keyed start..end ranges (end included), used to find the
+# keys with a range that may be relevant to some other range without looking
+# at all of them. Queries may return a few keys too many, never too few. The
+# opportunistic hashing candidates use this for their ranges of interest,
+# and the refcount stack for the ranges spanned by carvpaths.
+#
+import bisect
+
+
+class RangeIndex:
+    def __init__(self):
+        self.starts = []  # Sorted list of (start, key) tuples.
+        self.ranges = {}  # Map from key to (start, end) tuple.
+        self.maxsize = 0  # Size of the biggest range since index was empty.
+
+    def add(self, key, start, end):
+        self.remove(key)
+        bisect.insort(self.starts, (start, key))
+        self.ranges[key] = (start, end)
+        if end - start > self.maxsize:
+            self.maxsize = end - start
+
+    def remove(self, key):
+        if key in self.ranges:
+            start = self.ranges.pop(key)[0]
+            del self.starts[bisect.bisect_left(self.starts, (start, key))]
+            if len(self.ranges) == 0:
+                self.maxsize = 0
+
+    # Keys of all ranges that start within first..last
+    def starting_in(self, first, last):
+        low = bisect.bisect_left(self.starts, (first,))
+        high = bisect.bisect_left(self.starts, (last + 1,))
+        return [key for (start, key) in self.starts[low:high]]
+
+    # Keys of all ranges that overlap with first..last
+    def overlapping(self, first, last):
+        low = bisect.bisect_left(self.starts, (first - self.maxsize,))
+        high = bisect.bisect_left(self.starts, (last + 1,))
+        return [key for (start, key) in self.starts[low:high]
+                if self.ranges[key][1] >= first]
@@ -32,6 +32,9 @@
 # This should be replaced with a solution that uses a journal and/or a
 # distributed key/value store.
 #
+import collections
+import threading
+import time
 import redis
 
 
@@ -47,3 +50,108 @@ class LongPathMap:
 
     def __contains__(self, key):
         return self.redis.exists(key)
+
+    # Store a list of key/value pairs using a single pipelined round-trip.
+    def setmany(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        for (key, val) in items:
+            pipe.set(key, val)
+        pipe.execute()
+
+    # Nothing is ever kept back from redis, so nothing to flush.
+    def flush(self):
+        pass
+
+
+# Read-through and write-through cache in front of a LongPathMap.
+# Digests are content hashes, so once known a digest never changes and can be
+# cached forever (or untill evicted from the bounded LRU). Lookups that miss
+# are remembered for a short while only. New digests are stored before they
+# are handed out, so an other MattockFS instance never misses a digest it got
+# from us. Writes of digests by concurrent threads are grouped: while one
+# thread writes, new digests pile up and go out with a single pipelined
+# round-trip once that write is done.
+class CachingLongPathMap:
+    def __init__(self, lpmap=None, maxsize=65536, negative_ttl=1.0):
+        if lpmap is None:
+            lpmap = LongPathMap()
+        self.lpmap = lpmap
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.cache = collections.OrderedDict()  # Known digests, LRU order.
+        self.missing = {}  # Digests not found, with time of expiry.
+        self.pending = []  # Digests waiting for the current write to finish.
+        self.queued = 0  # Number of digests ever queued for writing.
+        self.stored = 0  # Number of those that have been written.
+        self.writing = False
+        # Shared between FUSE threads.
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+
+    # Nothing is ever kept back from the underlying map.
+    def flush(self):
+        self.lpmap.flush()
+
+    def _remember(self, key, val):
+        self.cache[key] = val
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def __getitem__(self, i):
+        with self.lock:
+            val = self.cache.pop(i, None)
+            if val is not None:
+                # Re-insert as to mark the digest as most recently used.
+                self.cache[i] = val
+                return val
+            if i in self.missing:
+                if self.missing[i] > time.time():
+                    return None
+                del self.missing[i]
+        val = self.lpmap[i]
+        with self.lock:
+            if val is None:
+                # Keep the negative cache bounded as well.
+                if len(self.missing) >= self.maxsize:
+                    self.missing.clear()
+                self.missing[i] = time.time() + self.negative_ttl
+            else:
+                self._remember(i, val)
+        return val
+
+    def __setitem__(self, i, val):
+        with self.lock:
+            # Digests never change, so there is no need to write a known one.
+            if i in self.cache:
+                return
+            self.missing.pop(i, None)
+            self.pending.append((i, val))
+            self.queued += 1
+            ticket = self.queued
+            while self.stored < ticket:
+                if self.writing:
+                    self.written.wait()
+                    continue
+                # No write in progress, write everything pending ourselves.
+                self.writing = True
+                pending = self.pending
+                upto = self.queued
+                self.pending = []
+                self.lock.release()
+                try:
+                    self.lpmap.setmany(pending)
+                except:
+                    self.lock.acquire()
+                    # Leave the digests of other threads for them to retry.
+                    self.pending = pending + self.pending
+                    self.writing = False
+                    self.written.notify_all()
+                    raise
+                self.lock.acquire()
+                self.stored = upto
+                self.writing = False
+                self.written.notify_all()
+            self._remember(i, val)
+
+    def __contains__(self, key):
+        return self[key] is not None
@@ -28,7 +28,37 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
 #
+import bisect
+import collections
+import heapq
+import threading
 import time
+import carvpath
+import rangeindex
+
+
+# Decorator for methods that need to hold the lock of their object.
+def _locked(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# The letters that may be used in a job selection policy.
+_POLICY_LETTERS = "RrODSWdH"
+
+# Letters whose sort value for a carvpath doesn't depend on the rest of the
+# refcount stack or the anycast set. The hashing offset (H) only ever grows.
+_STABLE_LETTERS = "OSH"
+
+# Number of refcount stack changes remembered for JobPicker updates.
+_MAX_CHANGES = 1024
+
+# Letters with sort values that get cached per carvpath. O and S values stay
+# valid as long as the carvpath remains on the stack, the others only untill
+# the refcount of any of the data in the carvpath changes.
+_CACHED_LETTERS = "RrODSWd"
 
 
 # Default implementation of < for argument list.
@@ -68,14 +98,37 @@ class CarvpathRefcountStack:
         # Entity refcount for handling multiple instances of the exact same
         # entity.
         self.entityrefcount = dict()
-        # A stack of fragments with different refcounts for keeping reference
-        # counts on fragments.
-        self.fragmentrefstack = []
-        # At least one empty entity on the stack
-        self.fragmentrefstack.append(self.context.empty())
+        # Reference counts on fragments are kept as an ordered map of boundary
+        # offsets. Each boundary starts a stretch of archive data that runs up
+        # to the next boundary (or the end of the archive for the last one)
+        # and has a single refcount for all of its bytes.
+        self.bounds = [0]
+        self.refcounts = [0]
+        # Total size of all data with a refcount > 0.
+        self.totalsize = 0
+        # Changes with every refcount update so derived data can be cached.
+        self.generation = 0
+        # The (start, end) ranges with refcount updates for each of the last
+        # generations, so that derived data can be updated incrementally.
+        self._changes = collections.deque(maxlen=_MAX_CHANGES)
+        # Lazily created stack of per refcount level entities.
+        self._levels = None
+        self._levelsgeneration = None
+        # Cached sort values for each job select policy letter, keyed by
+        # carvpath, and the per level byte counts R and D are derived from.
+        self._sortcache = dict((letter, {}) for letter in "OSWrd")
+        self._levelcache = {}
+        # Index on the range spanned by carvpaths with cached values that
+        # depend on refcounts.
+        self._cacheindex = rangeindex.RangeIndex()
+        # Cache hits and misses for each cached letter.
+        self._cachestats = dict((letter, [0, 0]) for letter in _CACHED_LETTERS)
         self.log = open(refcount_log, "a", 0)
+        # Lock for using the stack from multiple FUSE threads.
+        self.lock = threading.RLock()
 
     #Bypass Refcount stack to force fadvise to underlying data chunks
+    @_locked
     def carvpath_force_fadvise(self,carvpath,adv_string):
         adv_string = adv_string.upper()
         if "_" in adv_string:
@@ -103,22 +156,37 @@ class CarvpathRefcountStack:
           return False
 
     # Extract fadvise state infro on a single carvpath.
+    @_locked
     def carvpath_fadvise_info(self, carvpath):
         ent = self.context.parse(path=carvpath)
-        if (
-          ent.totalsize == 0 or
-          len(self.fragmentrefstack) == 0 or
-          self.fragmentrefstack[0].totalsize == 0):
-            overlapsize = 0
-        else:
-            # Create a copy of the entity without any sparse in it.
-            nonsparse = ent.copy(stripsparse=True)
-            # Calculate the overlap size between ent and refcount>0 data.
-            overlapsize = nonsparse.overlap_size(
-                            entity=self.fragmentrefstack[0])
+        overlapsize = 0
+        if ent.totalsize != 0 and self.totalsize != 0:
+            # The non sparse bytes of ent with a refcount > 0.
+            levelbytes = self._levelbytes(entity=ent)
+            if len(levelbytes) > 0:
+                overlapsize = levelbytes[0]
         return [overlapsize, ent.totalsize - overlapsize]
 
+    # Stack of entities with all fragments with a refcount larger than the
+    # index into the stack. Created from the boundary map on first use after
+    # any refcount update.
+    @property
+    def fragmentrefstack(self):
+        with self.lock:
+            if self._levelsgeneration != self.generation:
+                levels = []
+                for index in range(0, len(self.bounds) - 1):
+                    stretch = (self.bounds[index], self.bounds[index + 1])
+                    while len(levels) < self.refcounts[index]:
+                        levels.append([])
+                    for level in range(0, self.refcounts[index]):
+                        levels[level].append(stretch)
+                self._levels = [self._as_entity(ranges) for ranges in levels]
+                self._levelsgeneration = self.generation
+            return self._levels
+
     # Serialize whole stack; for debug purposes only.
+    @_locked
     def __str__(self):  # pragma: no cover
         rval = ""
         for index in range(0, len(self.fragmentrefstack)):
@@ -143,8 +211,9 @@ class CarvpathRefcountStack:
     #    count.(can be used for fadvise purposes)
     # 2) An entity with all fragments already in the box before add was
     #    invoked (can be used for opportunistic hashing purposes).
+    @_locked
     def add_carvpath(self, carvpath):
-        if carvpath in self.entityrefcount.keys():
+        if carvpath in self.entityrefcount:
             # Each CarvPath exists on the stack only once.
             self.entityrefcount[carvpath] += 1
             ent = self.content[carvpath]
@@ -160,9 +229,8 @@ class CarvpathRefcountStack:
             self.content[carvpath] = ent
             # Start refcount at one for this carvpath
             self.entityrefcount[carvpath] = 1
-            # Extend the stack with the non-sparse data from this carvpath.
-            r = self._stackextend(level=0, entity=ent)
-            merged = r[0]
+            # Count the non-sparse data from this carvpath.
+            merged = self._as_entity(self._adjust(entity=ent, delta=1))
             # Update the fadvise value for all refcount=0 -> refcount=1
             # transitions.
             for fragment in merged:
@@ -178,8 +246,9 @@ class CarvpathRefcountStack:
     # 1) An entity with all fragments that went from one to zero refcount
     #    (can be used for fadvise purposes).
     # 2) An entity with all fragments still remaining in the box.
+    @_locked
     def remove_carvpath(self, carvpath):
-        if carvpath not in self.entityrefcount.keys():
+        if carvpath not in self.entityrefcount:
             raise IndexError("Carvpath " + carvpath +
                              " not found on refcount stack.")
         self.entityrefcount[carvpath] -= 1
@@ -187,14 +256,12 @@ class CarvpathRefcountStack:
             # Reference count has reached zero, remove from content/refcount
             ent = self.content.pop(carvpath)
             del self.entityrefcount[carvpath]
+            self._uncache(carvpath=carvpath, static=True)
             # Remove carvpath as opportunistic hasing candidate
             self.ohashcollection.remove_carvpath(carvpath=carvpath)
-            # Deminish the stack with the non-sparse parts of this carvpath.
-            r = self._stackdiminish(
-                        level=len(self.fragmentrefstack)-1,
-                        entity=ent)
-            unmerged = r
-            if unmerged is not None:
+            # Uncount the non-sparse parts of this carvpath.
+            unmerged = self._as_entity(self._adjust(entity=ent, delta=-1))
+            if len(unmerged.fragments) > 0:
                 # If something has gone from refcount>0 to refcount=0,
                 # then update fadvise
                 for fragment in unmerged:
@@ -205,176 +272,232 @@ class CarvpathRefcountStack:
                     self.log.write(str(time.time()) + ":-:" + cp +"\n")
         return
 
-    def _create_sortmap_R(self, startset):
+    # For each refcount level, the number of bytes in entity that have a
+    # refcount higher than that level. The length of the list is the highest
+    # refcount found in entity.
+    def _levelbytes(self, entity):
+        histogram = {}
+        for (start, end) in _ranges(entity):
+            index = bisect.bisect_right(self.bounds, start) - 1
+            # The last stretch always has a zero refcount.
+            while index < len(self.bounds) - 1 and self.bounds[index] < end:
+                refcount = self.refcounts[index]
+                if refcount > 0:
+                    histogram[refcount] = (histogram.get(refcount, 0) +
+                                           min(end, self.bounds[index + 1]) -
+                                           max(start, self.bounds[index]))
+                index += 1
+        levelbytes = [0] * max(histogram.keys() + [0])
+        size = 0
+        for level in range(len(levelbytes) - 1, -1, -1):
+            size += histogram.get(level + 1, 0)
+            levelbytes[level] = size
+        return levelbytes
+
+    # Get the cached per level byte counts for carvpath, counting hits and
+    # misses for letter if given.
+    def _cached_levelbytes(self, carvpath, letter=None):
+        if carvpath in self._levelcache:
+            if letter is not None:
+                self._cachestats[letter][0] += 1
+            return self._levelcache[carvpath]
+        if letter is not None:
+            self._cachestats[letter][1] += 1
+        levelbytes = self._levelbytes(entity=self.content[carvpath])
+        self._levelcache[carvpath] = levelbytes
+        self._index_cached(carvpath=carvpath)
+        return levelbytes
+
+    # Get the cached sort value of carvpath for a letter.
+    def _cached_sortvalue(self, letter, carvpath):
+        cache = self._sortcache[letter]
+        if carvpath in cache:
+            self._cachestats[letter][0] += 1
+            return cache[carvpath]
+        self._cachestats[letter][1] += 1
+        value = getattr(self, "_sortvalue_" + letter)(carvpath=carvpath)
+        cache[carvpath] = value
+        if letter not in _STABLE_LETTERS:
+            self._index_cached(carvpath=carvpath)
+        return value
+
+    # Make sure refcount changes within carvpath will drop its cached values.
+    def _index_cached(self, carvpath):
+        ranges = _ranges(self.content[carvpath])
+        if len(ranges) > 0:
+            self._cacheindex.add(carvpath, ranges[0][0], ranges[-1][1] - 1)
+
+    # Drop the cached values for carvpath that depend on refcounts, and if
+    # static is set, the other ones as well.
+    def _uncache(self, carvpath, static=False):
+        self._cacheindex.remove(carvpath)
+        self._levelcache.pop(carvpath, None)
+        for letter in self._sortcache:
+            if static or letter not in _STABLE_LETTERS:
+                self._sortcache[letter].pop(carvpath, None)
+
+    # Get the sort value cache hits and misses for each cached job select
+    # policy letter.
+    @_locked
+    def sortkey_cache_info(self):
+        return [(letter, self._cachestats[letter][0],
+                 self._cachestats[letter][1])
+                for letter in _CACHED_LETTERS]
+
+    # The highest refcount of any of the data in carvpath.
+    @_locked
+    def maxrefcount(self, carvpath):
+        return len(self._cached_levelbytes(carvpath=carvpath))
+
+    # R and D are relative to the highest refcount level the whole input set
+    # overlaps with. If the set at hand is only part of the input set, the
+    # caller passes that level as toplevel.
+    def _create_sortmap_R(self, startset, toplevel=None):
         Rmap = {}
-        # Higest refcount level first down to the refcount=1 level
-        # untill we find some overlap.
-        stacksize = len(self.fragmentrefstack)
-        looklevel = stacksize - 1
-        somethingfound = False
-        for index in range(looklevel, -1, -1):
-            hrentity = self.fragmentrefstack[index]
-            # Search all overlaps at this level that are part of
-            # the input set.
-            for carvpath in startset:
-                if hrentity.overlaps(self.content[carvpath]):
-                    Rmap[carvpath] = True
-                    somethingfound = True
-                else:
-                    Rmap[carvpath] = False
-            # If we have at least one match, break from for loop.
-            if somethingfound:
-                break
-        if stacksize == 0:
-            for carvpath in startset:
-                Rmap[carvpath] = False
+        # Find the highest refcount level any of the input set overlaps with
+        # and mark the ones that do.
+        maxrefs = {}
+        for carvpath in startset:
+            maxrefs[carvpath] = len(self._cached_levelbytes(
+                                      carvpath=carvpath, letter="R"))
+        if toplevel is None:
+            toplevel = max(maxrefs.values() + [0])
+        for carvpath in startset:
+            Rmap[carvpath] = toplevel > 0 and maxrefs[carvpath] == toplevel
         return Rmap
 
+    def _sortvalue_r(self, carvpath):
+        # Only interested in refcount=1
+        return len(self._cached_levelbytes(carvpath=carvpath)) > 0
+
     def _create_sortmap_r(self, startset):
         rmap = {}
-        stacksize = len(self.fragmentrefstack)
-        if stacksize > 0:
-            # Only interested in refcount=1
-            hrentity = self.fragmentrefstack[0]
-            for carvpath in startset:
-                if hrentity.overlaps(self.content[carvpath]):
-                    rmap[carvpath] = True
-                else:
-                    rmap[carvpath] = False
-        else:
-            for carvpath in startset:
-                rmap[catvpath] = False
+        for carvpath in startset:
+            rmap[carvpath] = self._cached_sortvalue("r", carvpath)
         return rmap
 
+    def _sortvalue_O(self, carvpath):
+        offset = None
+        # Find fragment with the lowest offset.
+        for frag in self.content[carvpath].fragments:
+            if (offset is None or frag.issparse is False and
+               frag.offset < offset):
+                offset = frag.offset
+        return offset
+
     def _create_sortmap_O(self, startset):
         omap = {}
         for carvpath in startset:
-            offset = None
-            # Find fragment with the lowest offset.
-            for frag in self.content[carvpath].fragments:
-                if (offset is None or frag.issparse is False and
-                   frag.offset < offset):
-                    offset = frag.offset
-            omap[carvpath] = offset
+            omap[carvpath] = self._cached_sortvalue("O", carvpath)
         return omap
 
-    def _create_sortmap_D(self, startset):
+    def _create_sortmap_D(self, startset, toplevel=None):
         Dmap = {}
-        stacksize = len(self.fragmentrefstack)
-        looklevel = stacksize - 1
-        for index in range(looklevel, -1, -1):
-            hrentity = self.fragmentrefstack[index]
-            hasmatch = False
+        if self.totalsize > 0:
+            levelbytes = {}
+            for carvpath in startset:
+                levelbytes[carvpath] = self._cached_levelbytes(
+                                         carvpath=carvpath, letter="D")
+            if toplevel is None:
+                toplevel = max(map(len, levelbytes.values()) + [0])
             for carvpath in startset:
-                if hrentity.overlaps(
-                  self.content[carvpath]):
-                    # If overlaps: get+store density
+                # Density at the highest refcount level the input set
+                # overlaps with.
+                if toplevel > 0 and len(levelbytes[carvpath]) == toplevel:
                     Dmap[carvpath] = (
-                        self.content[carvpath].density(
-                            entity=hrentity))
-                    hasmatch = True
+                        float(levelbytes[carvpath][toplevel - 1]) /
+                        float(self.content[carvpath].totalsize))
                 else:
                     Dmap[carvpath] = 0.0
-            if hasmatch:
-                break
         return Dmap
 
+    def _sortvalue_S(self, carvpath):
+        return self.content[carvpath].totalsize
+
     def _create_sortmap_S(self, startset):
         smap = {}
         for carvpath in startset:
             if carvpath in self.content:
-                smap[carvpath] = (self.content[carvpath].totalsize)
+                smap[carvpath] = self._cached_sortvalue("S", carvpath)
         return smap
 
+    def _sortvalue_W(self, carvpath):
+        accumdensity = 0
+        for size in self._cached_levelbytes(carvpath=carvpath):
+            accumdensity += (float(size) /
+                             float(self.content[carvpath].totalsize))
+        return accumdensity
+
     def _create_sortmap_W(self, startset):
         wmap = {}
         for carvpath in startset:
-            accumdensity = 0
-            for index in range(
-                   0,
-                   len(self.fragmentrefstack)):
-                accumdensity += (
-                  self.content[carvpath].density(
-                    entity=self.fragmentrefstack[
-                             index]))
-            wmap[carvpath] = accumdensity
+            wmap[carvpath] = self._cached_sortvalue("W", carvpath)
         return wmap
 
+    def _sortvalue_d(self, carvpath):
+        levelbytes = self._cached_levelbytes(carvpath=carvpath)
+        if len(levelbytes) > 0:
+            return (float(levelbytes[0]) /
+                    float(self.content[carvpath].totalsize))
+        return 0.0
+
     def _create_sortmap_d(self, startset):
         dmap = {}
-        stacksize = len(self.fragmentrefstack)
-        if stacksize > 0:
+        if self.totalsize > 0:
             for carvpath in startset:
-                l = self.fragmentrefstack[0]
-                for carvpath in startset:
-                    if l.overlaps(
-                      self.content[carvpath]):
-                        dmap[carvpath] = (
-                            self.content[carvpath].density(
-                              entity=l))
-                    else:
-                        dmap[carvpath] = 0.0
+                dmap[carvpath] = self._cached_sortvalue("d", carvpath)
         return dmap
 
     def _create_sortmap_H(self, startset):
         hmap = {}
         for carvpath in startset:
             offset = None
-            hmap[carvpath] = self.ohashcollection.hashing_offset(carvpath)
+            hmap[carvpath] = self.ohashcollection.current_hashing_offset(
+                               carvpath)
         return hmap
 
+    # Create the sort maps for each of the letters of the job selection
+    # policy string.
+    def _create_sortmaps(self, params, startset, toplevel=None):
+        arglist = []
+        for letter in params:
+            if letter not in _POLICY_LETTERS:
+                raise RuntimeError("Invalid letter '" + letter +
+                                   "' for pickspecial policy")
+            if letter in "RD":
+                arglist.append(getattr(self, "_create_sortmap_" + letter)(
+                                 startset=startset, toplevel=toplevel))
+            else:
+                arglist.append(getattr(self, "_create_sortmap_" + letter)(
+                                 startset=startset))
+        return arglist
+
+    # Get the sort key tuples for a list of carvpaths under a job selection
+    # policy. These sort the same way as priority_custompick does by default.
+    # If the carvpaths are part of a larger set, toplevel should be the
+    # highest refcount level of that set.
+    @_locked
+    def sortkeys(self, params, carvpaths, toplevel=None):
+        arglist = self._create_sortmaps(params=params, startset=carvpaths,
+                                        toplevel=toplevel)
+        rval = {}
+        for carvpath in carvpaths:
+            # Just like _CustomSortable, leave out the maps that don't have
+            # a value for carvpath.
+            rval[carvpath] = tuple([somemap[carvpath] for somemap in arglist
+                                    if carvpath in somemap])
+        return rval
+
     # Pick the best job after custom sorting.
+    @_locked
     def priority_custompick(self, params, ltfunction=_defaultlt,
                             intransit=None, reverse=False):
-        # Set of maps to hand to use in custom sortable creation.
-        hmap = {}  # H(ashing offset)
-        # List of arguments for sorting, initially empty
-        arglist = []
         # Use intransit if its given, use all jobs if not.
         startset = intransit
         if startset is None:
             startset = set(self.content.keys())
-        stacksize = len(self.fragmentrefstack)
-        # Process the seperate letters of the job selection policy string
-        for letter in params:
-            if letter == "R":
-                arglist.append(self._create_sortmap_R(startset=startset))
-            else:
-                if letter == "r":
-                    arglist.append(self._create_sortmap_r(startset=startset))
-                else:
-                    if letter == "O":  # Offset
-                        arglist.append(
-                          self._create_sortmap_O(startset=startset))
-                    else:
-                        if letter == "D":  # Density
-                            arglist.append(self._create_sortmap_D(
-                                               startset=startset))
-                        else:
-                            if letter == "S":  # Size
-                                arglist.append(
-                                  self._create_sortmap_S(
-                                    startset=startset))
-                            else:
-                                if letter == "W":  # Weighted average refcount
-                                    arglist.append(
-                                      self._create_sortmap_W(
-                                        startset=startset))
-                                else:
-                                    if letter == "d":  # Density
-                                        arglist.append(
-                                          self._create_sortmap_d(
-                                            startset=startset))
-                                    else:
-                                        if letter == "H":
-                                            arglist.append(
-                                              self._create_sortmap_H(
-                                                startset=startset))
-                                        else:
-                                            raise RuntimeError(
-                                              "Invalid letter '" +
-                                              letter +
-                                              "' for pickspecial policy")
+        # List of arguments for sorting.
+        arglist = self._create_sortmaps(params=params, startset=startset)
         # Create a new array with CustomSortable objects.
         sortable = []
         for carvpath in startset:
@@ -391,49 +514,288 @@ class CarvpathRefcountStack:
               rval=candidate
         return rval;
 
-    # Extend the stack with fragments from entity.
-    # Recursive function starting at level zero.
-    def _stackextend(self, level, entity):
-        # If level does not exist, create it as empty.
-        if not (level < len(self.fragmentrefstack)):
-            self.fragmentrefstack.append(self.context.empty())
-        ent = self.fragmentrefstack[level]
-        # Merge with current level.
-        res = ent.merge(entity)
-        merged = res[1]
-        unmerged = res[0]
-        # Recursively call self for next level with unmerged frags
-        if (len(unmerged.fragments) != 0):
-            self._stackextend(level + 1, unmerged)
-        return [merged, unmerged]
-
-    # Deminish the stack with fragments from entity.
-    # Recursive function starting at highest level first.
-    def _stackdiminish(self, level, entity):
-        # Start with unmerging at this level
-        ent = self.fragmentrefstack[level]
-        res = ent.unmerge(entity)
-        unmerged = res[1]
-        remaining = res[0]
-        # If unmerging resulted in depletion of this level, remove level from
-        # stack.
-        if len(self.fragmentrefstack[level].fragments) == 0:
-            self.fragmentrefstack.pop(level)
-        # If there are additional fragments to unmerge, look at processing
-        # these
-        if len(remaining.fragments) > 0:
-            # Should not happen at level zero.
-            if level == 0:
-                raise RuntimeError(
-                  "Data remaining after _stackdiminish at level 0")
-            # Unmerge at one level lower and anything below that.
-            return self._stackdiminish(level - 1, remaining)
+    # Make sure offset is a boundary in the refcount map and return its index.
+    def _split(self, offset):
+        index = bisect.bisect_right(self.bounds, offset) - 1
+        if self.bounds[index] != offset:
+            index += 1
+            self.bounds.insert(index, offset)
+            self.refcounts.insert(index, self.refcounts[index - 1])
+        return index
+
+    # Drop a boundary if it no longer seperates two different refcounts.
+    def _join(self, index):
+        if (index > 0 and index < len(self.bounds) and
+           self.refcounts[index] == self.refcounts[index - 1]):
+            del self.bounds[index]
+            del self.refcounts[index]
+
+    # Get the (start, end) ranges with refcount updates since generation, or
+    # None if those are no longer known.
+    @_locked
+    def changes_since(self, generation):
+        if generation == self.generation:
+            return []
+        if (len(self._changes) == 0 or
+           self._changes[0][0] > generation + 1):
+            return None
+        rval = []
+        for (changegeneration, ranges) in reversed(self._changes):
+            if changegeneration <= generation:
+                break
+            rval.extend(ranges)
+        return rval
+
+    # Add delta to the refcount of all data in entity. Returns the list of
+    # (start, end) ranges that went from refcount zero to one or back.
+    def _adjust(self, entity, delta):
+        transitions = []
+        ranges = _ranges(entity)
+        for (start, end) in ranges:
+            first = self._split(start)
+            last = self._split(end)
+            for index in range(first, last):
+                refcount = self.refcounts[index] + delta
+                if refcount < 0:
+                    raise RuntimeError(
+                      "Negative refcount at offset " + str(self.bounds[index]))
+                if refcount == 0 or self.refcounts[index] == 0:
+                    transitions.append((self.bounds[index],
+                                        self.bounds[index + 1]))
+                self.refcounts[index] = refcount
+            # Only the outer boundaries can have become redundant.
+            self._join(last)
+            self._join(first)
+            # Cached sort values depending on these refcounts are stale now.
+            for cp in self._cacheindex.overlapping(start, end - 1):
+                self._uncache(carvpath=cp)
+        size = 0
+        for (start, end) in transitions:
+            size += end - start
+        self.totalsize += size * delta
+        self.generation += 1
+        self._changes.append((self.generation, ranges))
+        return transitions
+
+    # Entity made up of the given sorted (start, end) ranges.
+    def _as_entity(self, ranges):
+        ent = self.context.empty()
+        for (start, end) in ranges:
+            ent.unaryplus(other=carvpath.Fragment(offset=start,
+                                                  size=end - start))
+        return ent
+
+
+# Sorted non overlapping (start, end) ranges of the non sparse data in entity.
+def _ranges(entity):
+    ranges = []
+    nosparse = [frag for frag in entity.fragments if not frag.issparse()]
+    for frag in sorted(nosparse):
+        end = frag.offset + frag.size
+        if len(ranges) > 0 and frag.offset <= ranges[-1][1]:
+            if end > ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], end)
         else:
-            if level == 0:
-                # At level zero, return the refcount1->refcount0 fragments.
-                return unmerged
-            else:
-                return None
+            ranges.append((frag.offset, end))
+    return ranges
+
+
+# Priority queue for picking jobs from an anycast set under a single job
+# selection policy.
+class _PolicyQueue:
+    def __init__(self, policy):
+        self.policy = policy
+        # Heap of (sortkey, arrival, carvpath) tuples.
+        self.heap = []
+        # The current heap entry for each carvpath, any other entries for a
+        # carvpath are stale.
+        self.entries = {}
+        # Sort keys with a hashing offset need a refresh before use.
+        self.hashing = "H" in policy
+        # Sort keys for stable queues never change because of refcount
+        # updates.
+        self.stable = True
+        for letter in policy:
+            if letter not in _STABLE_LETTERS:
+                self.stable = False
+        # R and D depend on the highest refcount level in the whole set.
+        self.settop = "R" in policy or "D" in policy
+        # D and d are left out of the sort keys while the stack holds no data.
+        self.usesdata = "D" in policy or "d" in policy
+        self.valid = False
+        self.generation = None
+        self.hasdata = False
+        # Highest refcount level of each carvpath in the set, the highest
+        # of those and the number of carvpaths at that level.
+        self.levels = {}
+        self.toplevel = 0
+        self.attop = 0
+
+
+# Incremental job picker for a single anycast set. Rather than sorting the
+# whole set on every pick, a heap is kept for each job selection policy used
+# so far. Jobs get pushed as they are added. After refcount stack changes,
+# only the carvpaths that overlap with the changed data get new entries
+# pushed. A heap only gets rebuilt if too many changes were missed, if the
+# highest refcount level in the set changed for a policy with R or D in it,
+# or if it holds too many stale entries. Stale entries get dropped when they
+# reach the top of the heap.
+class JobPicker:
+    def __init__(self, stack):
+        self.stack = stack
+        self.lock = stack.lock
+        # Arrival number and job count for each carvpath in the set.
+        self.members = {}
+        self.arrivals = 0
+        self.queues = {}
+        # Index on the range spanned by each carvpath in the set.
+        self.index = rangeindex.RangeIndex()
+
+    def __len__(self):
+        return len(self.members)
+
+    # A job for carvpath was added to the anycast set.
+    @_locked
+    def add(self, carvpath):
+        if carvpath in self.members:
+            self.members[carvpath][1] += 1
+            return
+        self.arrivals += 1
+        self.members[carvpath] = [self.arrivals, 1]
+        if carvpath in self.stack.content:
+            ranges = _ranges(self.stack.content[carvpath])
+            if len(ranges) > 0:
+                self.index.add(carvpath, ranges[0][0], ranges[-1][1] - 1)
+        for queue in self.queues.values():
+            if queue.valid:
+                self._update(queue, [carvpath])
+
+    # A job for carvpath was taken from the anycast set.
+    @_locked
+    def remove(self, carvpath):
+        self.members[carvpath][1] -= 1
+        if self.members[carvpath][1] > 0:
+            return
+        del self.members[carvpath]
+        self.index.remove(carvpath)
+        for queue in self.queues.values():
+            queue.entries.pop(carvpath, None)
+            # Other carvpaths keep their R and D values unless this was the
+            # last one at the highest refcount level in the set.
+            if queue.settop and queue.valid:
+                if queue.levels.pop(carvpath, None) == queue.toplevel:
+                    queue.attop -= 1
+                    if queue.attop == 0:
+                        queue.valid = False
+
+    # Fill the heap of a queue from scratch.
+    def _rebuild(self, queue):
+        carvpaths = self.members.keys()
+        if queue.settop:
+            queue.levels = dict((carvpath,
+                                 self.stack.maxrefcount(carvpath=carvpath))
+                                for carvpath in carvpaths)
+            queue.toplevel = max(queue.levels.values() + [0])
+            queue.attop = queue.levels.values().count(queue.toplevel)
+        sortkeys = self.stack.sortkeys(params=queue.policy,
+                                       carvpaths=carvpaths,
+                                       toplevel=queue.toplevel)
+        queue.heap = []
+        queue.entries = {}
+        for carvpath in carvpaths:
+            entry = (sortkeys[carvpath], self.members[carvpath][0], carvpath)
+            queue.heap.append(entry)
+            queue.entries[carvpath] = entry
+        heapq.heapify(queue.heap)
+        queue.valid = True
+        queue.generation = self.stack.generation
+        queue.hasdata = self.stack.totalsize > 0
+
+    # Push new entries for carvpaths whose sort key may have changed, unless
+    # that changes the highest refcount level in the set, in which case the
+    # queue is marked for a rebuild.
+    def _update(self, queue, carvpaths):
+        if queue.settop:
+            for carvpath in carvpaths:
+                level = self.stack.maxrefcount(carvpath=carvpath)
+                if queue.levels.get(carvpath) == queue.toplevel:
+                    queue.attop -= 1
+                queue.levels[carvpath] = level
+                if level > queue.toplevel:
+                    queue.valid = False
+                    return
+                if level == queue.toplevel:
+                    queue.attop += 1
+            if queue.attop == 0:
+                queue.valid = False
+                return
+        sortkeys = self.stack.sortkeys(params=queue.policy,
+                                       carvpaths=carvpaths,
+                                       toplevel=queue.toplevel)
+        for carvpath in carvpaths:
+            entry = (sortkeys[carvpath], self.members[carvpath][0], carvpath)
+            heapq.heappush(queue.heap, entry)
+            queue.entries[carvpath] = entry
+
+    # Update the sort keys of a queue for the refcount stack changes since
+    # it was last used.
+    def _catch_up(self, queue):
+        if queue.stable or queue.generation == self.stack.generation:
+            return
+        if queue.usesdata and queue.hasdata != (self.stack.totalsize > 0):
+            queue.valid = False
+            return
+        changes = self.stack.changes_since(generation=queue.generation)
+        if changes is None:
+            queue.valid = False
+            return
+        queue.generation = self.stack.generation
+        affected = set()
+        for (start, end) in changes:
+            affected.update(self.index.overlapping(start, end - 1))
+        if len(affected) > 0:
+            self._update(queue, list(affected))
+
+    # Get the carvpath of the best job according to the job selection
+    # policy, or None if the set is empty.
+    @_locked
+    def pick(self, policy):
+        if len(self.members) == 0:
+            return None
+        if policy not in self.queues:
+            for letter in policy:
+                if letter not in _POLICY_LETTERS:
+                    raise RuntimeError("Invalid letter '" + letter +
+                                       "' for pickspecial policy")
+            self.queues[policy] = _PolicyQueue(policy)
+        queue = self.queues[policy]
+        if queue.valid:
+            self._catch_up(queue)
+        if (not queue.valid or
+           len(queue.heap) > 2 * len(self.members) + 64):
+            self._rebuild(queue)
+        while True:
+            entry = queue.heap[0]
+            (sortkey, arrival, carvpath) = entry
+            # Drop entries for carvpaths that have left the set or that got
+            # a newer entry.
+            if queue.entries.get(carvpath) is not entry:
+                heapq.heappop(queue.heap)
+                continue
+            # Hashing offsets only grow, so stale ones can only make an
+            # entry look better than it is. Values may be left out of a sort
+            # key, so get the whole key again rather than just its hashing
+            # offsets.
+            if queue.hashing:
+                current = self.stack.sortkeys(
+                            params=queue.policy, carvpaths=[carvpath],
+                            toplevel=queue.toplevel)[carvpath]
+                if current != sortkey:
+                    entry = (current, arrival, carvpath)
+                    queue.entries[carvpath] = entry
+                    heapq.heapreplace(queue.heap, entry)
+                    continue
+            return carvpath
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -30,8 +30,11 @@
 #
 import errno
 import copy
+import io
+import mmap
 import os
 import fcntl
+import threading
 import carvpath
 import refcount_stack
 import opportunistic_hash
@@ -90,15 +93,189 @@ class _RaiiFLock:
         fcntl.flock(self.fd, fcntl.LOCK_UN)
 
 
+# Positional reads and writes on the archive file that don't depend on a
+# shared file offset, so any number of threads can use them concurrently.
+# Uses os.preadv/os.pwrite if available. Python 2 doesn't have these, so
+# there each read or write checks out a file descriptor (and thus its own
+# file offset) for the archive from a bounded pool instead. FUSE threads come
+# and go, so descriptors are never tied to a thread.
+class _PositionalIO:
+    def __init__(self, path, fd, maxfds=16):
+        self.path = path
+        self.fd = fd
+        self.positional = hasattr(os, "preadv") and hasattr(os, "pwrite")
+        self.maxfds = maxfds
+        self.idle = []  # File objects not currently checked out.
+        self.opened = 0
+        self.closed = False
+        self.available = threading.Condition(threading.Lock())
+
+    # Check out a file object, opening a new one while below maxfds or else
+    # waiting for one to be returned.
+    def _checkout(self):
+        with self.available:
+            while len(self.idle) == 0 and self.opened >= self.maxfds:
+                self.available.wait()
+            if len(self.idle) > 0:
+                return self.idle.pop()
+            self.opened += 1
+        try:
+            fd = os.open(self.path, (os.O_RDWR |
+                                     os.O_LARGEFILE |
+                                     os.O_NOATIME))
+            return io.FileIO(fd, "r+", closefd=True)
+        except:
+            with self.available:
+                self.opened -= 1
+                self.available.notify()
+            raise
+
+    def _return(self, fileobj):
+        with self.available:
+            if self.closed:
+                fileobj.close()
+                self.opened -= 1
+                return
+            self.idle.append(fileobj)
+            self.available.notify()
+
+    # Read into a writable buffer (memoryview) from offset. Returns the
+    # number of bytes read, zero at the end of the file.
+    def preadinto(self, view, offset):
+        if self.positional:
+            return os.preadv(self.fd, [view], offset)
+        fileobj = self._checkout()
+        try:
+            fileobj.seek(offset)
+            return fileobj.readinto(view)
+        finally:
+            self._return(fileobj)
+
+    # Write all of data to offset.
+    def pwrite(self, data, offset):
+        if self.positional:
+            written = 0
+            while written < len(data):
+                written += os.pwrite(self.fd, data[written:], offset + written)
+            return
+        fileobj = self._checkout()
+        try:
+            written = 0
+            while written < len(data):
+                fileobj.seek(offset + written)
+                written += fileobj.write(data[written:])
+        finally:
+            self._return(fileobj)
+
+    # Close all idle file objects, those still checked out get closed when
+    # returned.
+    def close(self):
+        with self.available:
+            for fileobj in self.idle:
+                fileobj.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+            self.closed = True
+
+
+# Read-only shared memory mapping of the archive file. The mapping is
+# (re)created lazily whenever a read goes beyond the end of the current one,
+# so growing the archive, by us or by an other MattockFS instance, doesn't
+# cost a remap untill the new data actually gets read. Old mappings are never
+# closed explicitly, views handed out earlier keep them alive.
+class _ArchiveMap:
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+        self.mapping = None
+        self.data = None
+        self.size = 0
+
+    def _remap(self):
+        size = os.fstat(self.fd).st_size
+        if size > self.size:
+            self.mapping = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+            try:
+                self.data = memoryview(self.mapping)
+            except TypeError:
+                # Python 2 mmap objects only have the old buffer interface.
+                self.data = None
+            self.size = size
+
+    # Get a zero-copy view on size bytes of archive data at offset, or None if
+    # the data lies beyond the end of the archive.
+    def view(self, offset, size):
+        with self.lock:
+            if offset + size > self.size:
+                self._remap()
+            if offset + size > self.size:
+                return None
+            if self.data is None:
+                return buffer(self.mapping, offset, size)
+            return self.data[offset:offset + size]
+
+
+# Low priority background thread that completes opportunistic hashes of
+# carvpaths still in use, and thus likely still in the page cache, by reading
+# their un-hashed data in blocks of blocksize. Once the volume of data with a
+# refcount > 0 (see getTopThrottleInfo) exceeds maxhot, that data no longer
+# fits in the page cache and reading it would compete with the workers for
+# disk I/O, so the hasher pauses.
+class _BackgroundHasher(threading.Thread):
+    def __init__(self, rep, blocksize=1048576, interval=0.01, maxhot=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rep = rep
+        self.interval = interval
+        if maxhot is None:
+            # Default to half of the physical memory.
+            maxhot = (os.sysconf("SC_PHYS_PAGES") *
+                      os.sysconf("SC_PAGE_SIZE") // 2)
+        self.maxhot = maxhot
+        self.buffer = bytearray(blocksize)
+        # Candidates we couldn't read any data for, beyond the archive end.
+        self.stalled = set()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.step()
+
+    # Read and hash a single block, if there is anything to hash.
+    def step(self):
+        if self.rep.getTopThrottleInfo()[0] > self.maxhot:
+            return
+        col = self.rep.col
+        self.stalled = set(cp for cp in self.stalled if cp in col.ohash)
+        candidate = col.catch_up_chunk(maxsize=len(self.buffer),
+                                       exclude=self.stalled)
+        if candidate is None:
+            return
+        (cp, offset, size, hashoffset) = candidate
+        view = memoryview(self.buffer)[:size]
+        count = self.rep.pio.preadinto(view=view, offset=offset)
+        if count:
+            col.catch_up_data(carvpath=cp, hashoffset=hashoffset,
+                              data=view[:count])
+        else:
+            self.stalled.add(cp)
+
+
 # Class representing an open file. This can either be a mutable or a carvpath
 # file.
 class _OpenFile:
-    def __init__(self, stack, cp, entity, fd, ohashcollection):
+    def __init__(self, stack, cp, entity, pio, ohashcollection, amap=None):
         self.cp = cp
         self.stack = stack
         self.ohashcollection = ohashcollection
         self.entity = entity
-        self.fd = fd
+        self.pio = pio
+        self.amap = amap
         # Add the carvpath to the refcount stack.
         self.stack.add_carvpath(carvpath=cp)
         self.refcount = 1  # Note: This refcount is maintained by the
@@ -109,20 +286,22 @@ class _OpenFile:
         # Remove from refcount stack on deletion.
         self.stack.remove_carvpath(carvpath=self.cp)
 
-    def pread(self, chunk):
-        # Read the chunk from offset, os.pread would be better but does not
-        # exist in python 2.
-        if chunk.issparse():
-            return "\0" * chunk.size
-        else:
-            os.lseek(self.fd, chunk.offset, 0)
-            return os.read(self.fd, chunk.size)
+    def pread(self, chunk, view):
+        # Read the chunk from offset straight into view, a memoryview on a
+        # zero filled buffer of chunk size. Sparse chunks are left zero.
+        if not chunk.issparse():
+            filled = 0
+            while filled < chunk.size:
+                count = self.pio.preadinto(view=view[filled:],
+                                           offset=chunk.offset + filled)
+                if not count:
+                    # Beyond the end of the archive; leave zeroes.
+                    break
+                filled += count
 
     def pwrite(self, chunk, chunkdata):
-        # Write a chunk to the proper offset. os.pwrite would be better but
-        # does not exist in python 2.
-        os.lseek(self.fd, chunk.offset, 0)
-        os.write(self.fd, chunkdata)
+        # Write a chunk to the proper offset.
+        self.pio.pwrite(data=chunkdata, offset=chunk.offset)
         return
 
     def read(self, offset, size):
@@ -134,17 +313,39 @@ class _OpenFile:
                                         offset=offset,
                                         size=size)]),
           truncate=True)
-        # Start with empty result.
-        result = b''
+        if self.amap is not None and len(readent.fragments) == 1:
+            # Single fragment read in mmap mode, copy straight from the
+            # mapped pages.
+            chunk = readent.fragments[0]
+            if not chunk.issparse():
+                datachunk = self.amap.view(offset=chunk.offset,
+                                           size=chunk.size)
+                if datachunk is not None:
+                    self.ohashcollection.lowlevel_read_data(
+                      offset=chunk.offset,
+                      data=datachunk)
+                    return bytes(datachunk)
+        # Start with a single zero filled result buffer and fill it in place.
+        result = bytearray(readent.totalsize)
+        view = memoryview(result)
+        resultindex = 0
         for chunk in readent:  # One entity chunk at a time.
-            datachunk = self.pread(chunk=chunk)  # Read chunk from  offset
-            result += datachunk  # Add chunk to result.
+            datachunk = view[resultindex:resultindex + chunk.size]
+            mapped = None
+            if self.amap is not None and not chunk.issparse():
+                mapped = self.amap.view(offset=chunk.offset, size=chunk.size)
+            if mapped is not None:
+                datachunk[:] = mapped  # Copy chunk from the mapping.
+                datachunk = mapped
+            else:
+                self.pread(chunk=chunk, view=datachunk)  # Read from offset
+            resultindex += chunk.size
             if not chunk.issparse():
                 self.ohashcollection.lowlevel_read_data(
                   offset=chunk.offset,
                   data=datachunk)  # Do opportunistic hasing
                   #                  if possible.
-        return result
+        return bytes(result)
 
     def write(self, offset, data):
         size = len(data)
@@ -171,22 +372,37 @@ class _OpenFile:
 
 
 class Repository:
-    def __init__(self, reppath, context, ohash_log, refcount_log):
+    def __init__(self, reppath, context, ohash_log, refcount_log,
+                 mmap_reads=False, background_hashing=False,
+                 hashing_offload=False):
         self.context = context
         # Create a new opportunistic hash collection.
         self.col = opportunistic_hash.OpportunisticHashCollection(
                          carvpathcontext=context,
                          ohash_log=ohash_log)
+        if hashing_offload:
+            # Do the hashing on a dedicated thread instead.
+            self.col = opportunistic_hash.OffloadedHashCollection(
+                         collection=self.col)
         # We start off with zero open files
         self.openfiles = {}
+        # Lock for the openfiles map and lock for growing the archive.
+        self.openlock = threading.Lock()
+        self.growlock = threading.Lock()
         # Open the underlying data file and create if needed.
         self.fd = os.open(reppath,
                           (os.O_RDWR |
                            os.O_LARGEFILE |
                            os.O_NOATIME |
                            os.O_CREAT))
+        # All data I/O uses positional reads and writes.
+        self.pio = _PositionalIO(path=reppath, fd=self.fd)
+        # Optionally serve reads from a memory mapping of the archive.
+        self.amap = None
+        if mmap_reads:
+            self.amap = _ArchiveMap(fd=self.fd)
         # Get the current repository total size.
-        cursize = os.lseek(self.fd, 0, os.SEEK_END)
+        cursize = os.fstat(self.fd).st_size
         # Set the entire repository as dontneed and assume everything to be
         # cold data for now.
         posix_fadvise(self.fd, 0, cursize, POSIX_FADV_DONTNEED)
@@ -201,27 +417,43 @@ class Repository:
               fadvise=fadvise,
               ohashcollection=self.col,
               refcount_log=refcount_log)
+        # Optionally complete opportunistic hashes in the background.
+        self.hasher = None
+        if background_hashing:
+            self.hasher = _BackgroundHasher(rep=self)
+            self.hasher.start()
 
     def __del__(self):
+        self.finish_hashing()
         self.stack = None
         self.openfiles = None
         # On destruction close the underlying file.
+        self.pio.close()
         os.close(self.fd)
 
+    # Stop background hashing and finish any offloaded hashing.
+    def finish_hashing(self):
+        if self.hasher is not None:
+            self.hasher.stop()
+            self.hasher = None
+        if isinstance(self.col, opportunistic_hash.OffloadedHashCollection):
+            self.col.close()
+
     def _grow(self, chunksize):
         # Use a file lock to atomically allocate a new chunk of
-        # (at first sparse) file data.
-        l = _RaiiFLock(fd=self.fd)
-        cursize = os.lseek(self.fd, 0, os.SEEK_END)
-        os.ftruncate(self.fd, cursize+chunksize)
-        self.top.grow(chunk=cursize + chunksize - self.top.size)
-        return cursize
+        # (at first sparse) file data. The file lock doesn't exclude other
+        # threads using the same fd, so we need a thread lock as well.
+        with self.growlock:
+            l = _RaiiFLock(fd=self.fd)
+            cursize = os.fstat(self.fd).st_size
+            os.ftruncate(self.fd, cursize+chunksize)
+            self.top.grow(chunk=cursize + chunksize - self.top.size)
+            return cursize
 
     def snapshot(self,data):
         chunksize = len(data)
         offset = self._grow(chunksize=chunksize)
-        os.lseek(self.fd, offset, 0)
-        os.write(self.fd, data)
+        self.pio.pwrite(data=data, offset=offset)
         cp = str(carvpath._Entity(lpmap=self.context.longpathmap,
                                   maxfstoken=self.context.maxfstoken,
                                   fragments=[
@@ -232,10 +464,11 @@ class Repository:
     # It multiple instances of MattockFS use the same repository,
     # sync archive size with the underlying file size.
     def multi_sync(self):
-        cursize = os.lseek(self.fd, 0, os.SEEK_END)
-        grown = cursize - self.top.size
-        self.top.grow(chunk=grown)
-        return grown
+        with self.growlock:
+            cursize = os.fstat(self.fd).st_size
+            grown = cursize - self.top.size
+            self.top.grow(chunk=grown)
+            return grown
 
     # Allocate a new piece of mutable data and return CarvPath
     def newmutable(self, chunksize):
@@ -248,13 +481,13 @@ class Repository:
                                   fragments=[
                                      carvpath.Fragment(offset=chunkoffset,
                                                        size=chunksize)]))
+        # Keep background hashing away from it untill frozen.
+        self.col.add_mutable(carvpath=cp)
         return cp
 
     # Return the size of the part of the repository with a refcount > 0
     def volume(self):
-        if len(self.stack.fragmentrefstack) == 0:
-            return 0
-        return self.stack.fragmentrefstack[0].totalsize
+        return self.stack.totalsize
 
     # Check if a given carvpath is valid and possible within the repository
     # size.
@@ -286,14 +519,21 @@ class Repository:
     def anycast_set_volume(self, anycast):
         volume = 0
         for jobid in anycast:
-            cp = anycast[jobid].carvpath
-            volume += self.context.parse(
-                  path=anycast[jobid].carvpath).totalsize
+            volume += anycast[jobid].size
         return volume
 
+    # Create an incremental job picker for an anycast set.
+    def anycast_picker(self):
+        return refcount_stack.JobPicker(stack=self.stack)
+
     # Get the most suitable entity from a given set according to given policy
-    def anycast_best(self, anycast, sort_policy):
+    def anycast_best(self, anycast, sort_policy, picker=None, cp2jobs=None):
         if len(anycast) > 0:
+            if picker is not None:
+                # Let the picker kept for the set find the best carvpath and
+                # return the oldest job for it from the set's carvpath to
+                # job handles map.
+                return cp2jobs[picker.pick(policy=sort_policy)][0]
             # Convert anycast set to a carvpath indexed map.
             cp2key = {}
             for anycastkey in anycast.keys():
@@ -319,37 +559,31 @@ class Repository:
     # For use by loadbalancer; get best actor, if any, for load balancing job
     # selection.
     def anycast_best_actors(self, actorsstate, actorset, letter):
-        # Only fetch the volume later on if V/C/D is in the policy.
-        fetchvolume = False
-        if letter in "VDC":
-            fetchvolume = True
         # Start with empty set as best actors.
         bestactors = set()
         bestval = 0
         for actor in actorset:
-            anycast = actorsstate.actors[actor].anycast
+            # Running job count and volume kept by the actor for its set.
+            setsize = actorsstate.actors[actor].set_size
+            volume = actorsstate.actors[actor].set_volume
             # Only sets where the job count exceeds the overflow are canddates
             overflow = actorsstate.actors[actor].overflow
-            if len(anycast) > overflow:
-                # Fetch set volume if policy demands it.
-                volume = 0
-                if fetchvolume:
-                    volume = self.anycast_set_volume(anycast=anycast)
+            if setsize > overflow:
                 val = 0
                 # Get the value to find the best actor with depending on
                 # policy letter.
                 if letter == "S":
-                    val = len(anycast)  # Number of jobs in the set.
+                    val = setsize  # Number of jobs in the set.
                 if letter == "V":
                     val = volume        # Total carvpath volume of the set.
                 if letter == "D":
                     if volume > 0:
                         # Jobs per byte of carvpath volume.
-                        val = float(len(anycast))/float(volume)
+                        val = float(setsize)/float(volume)
                     else:
-                        if len(anycast) > 0:
+                        if setsize > 0:
                             # Big number avoiding divide by zero
-                            val = 100*len(anycast)
+                            val = 100*setsize
                 if letter == "W":
                     # The weight of the actor
                     val = actorsstate[actor].weight
@@ -357,11 +591,11 @@ class Repository:
                     if volume > 0:
                         # weight normalized jobs per byte of carvpath volume.
                         val = (float(actorsstate[actor].weight) *
-                               float(len(anycast))/float(volume))
+                               float(setsize)/float(volume))
                     else:
-                        if len(anycast) > 0:
+                        if setsize > 0:
                             # Big number avoiding divide by zero.
-                            val = 100*len(anycast)*actorsstate[actor].weight
+                            val = 100*setsize*actorsstate[actor].weight
                 if val > bestval:
                     # If the current value is better than the best value,
                     # update best and start with a new set of best actors.
@@ -375,32 +609,42 @@ class Repository:
 
     # Open a pseudo file within the repository.
     def open(self, carvpath, path):
-        if path in self.openfiles:
-            # If a copy of this file is already opened, increase the
-            # reference count.
-            self.openfiles[path].refcount += 1
-        else:
-            # Otherwise, parse the carvpath and create a new entry in the
-            # openfiles map.
-            ent = self.context.parse(path=carvpath)
-            col = self.stack.ohashcollection
-            self.openfiles[path] = _OpenFile(stack=self.stack,
-                                             cp=carvpath,
-                                             entity=ent,
-                                             fd=self.fd,
-                                             ohashcollection=col)
+        with self.openlock:
+            if path in self.openfiles:
+                # If a copy of this file is already opened, increase the
+                # reference count.
+                self.openfiles[path].refcount += 1
+            else:
+                # Otherwise, parse the carvpath and create a new entry in the
+                # openfiles map.
+                ent = self.context.parse(path=carvpath)
+                col = self.stack.ohashcollection
+                self.openfiles[path] = _OpenFile(stack=self.stack,
+                                                 cp=carvpath,
+                                                 entity=ent,
+                                                 pio=self.pio,
+                                                 ohashcollection=col,
+                                                 amap=self.amap)
         return 0
 
+    # Get an open file, or None. The actual reading and writing is done
+    # without holding the openfiles lock.
+    def _openfile(self, path):
+        with self.openlock:
+            return self.openfiles.get(path)
+
     # Read data from an open file
     def read(self, path, offset, size):
-        if path in self.openfiles:
-            return self.openfiles[path].read(offset=offset, size=size)
+        openfile = self._openfile(path)
+        if openfile is not None:
+            return openfile.read(offset=offset, size=size)
         return -errno.EIO
 
     # Write data to an open file.
     def write(self, path, offset, data):
-        if path in self.openfiles:
-            return self.openfiles[path].write(offset=offset, data=data)
+        openfile = self._openfile(path)
+        if openfile is not None:
+            return openfile.write(offset=offset, data=data)
         return -errno.EIO
 
     def flush(self):
@@ -408,11 +652,12 @@ class Repository:
 
     # Close a file.
     def close(self, path):
-        # Decrement refcount.
-        self.openfiles[path].refcount -= 1
-        # Only delete open file once refcount reaches zero.
-        if self.openfiles[path].refcount < 1:
-            del self.openfiles[path]
+        with self.openlock:
+            # Decrement refcount.
+            self.openfiles[path].refcount -= 1
+            # Only delete open file once refcount reaches zero.
+            if self.openfiles[path].refcount < 1:
+                del self.openfiles[path]
         return 0
 
 
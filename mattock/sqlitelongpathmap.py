@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# Copyright (c) 2015, Rob J Meijer.
+# Copyright (c) 2015, University College Dublin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the <organization>.
+# 4. Neither the name of the <organization> nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY <COPYRIGHT HOLDER> ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
+#
+# Embedded alternative for the redis based long path map. Digests are kept in
+# a single SQLite database file that may be shared by all MattockFS instances
+# on a node, so no separate redis-server is needed for single node setups.
+#
+import sqlite3
+import threading
+
+
+class LongPathMap:
+    def __init__(self, dbpath="/var/mattock/archive/longpath.sqlite"):
+        # Autocommit mode, setmany uses an explicit transaction. The
+        # connection is shared between FUSE threads, guarded by our lock.
+        self.db = sqlite3.connect(dbpath, isolation_level=None, timeout=30,
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.text_factory = str
+        # Write ahead logging lets readers in other instances continue while
+        # we write, and a memory mapped database avoids a read syscall per
+        # lookup.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA mmap_size=268435456")
+        self.db.execute("CREATE TABLE IF NOT EXISTS longpath ("
+                        "digest TEXT PRIMARY KEY, path TEXT NOT NULL)")
+
+    def __getitem__(self, i):
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT path FROM longpath WHERE digest = ?",
+                    (i,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def __setitem__(self, i, val):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO longpath VALUES (?, ?)",
+                            (i, val))
+
+    def __contains__(self, key):
+        return self[key] is not None
+
+    # Store a list of key/value pairs in a single transaction.
+    def setmany(self, items):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                  "INSERT OR IGNORE INTO longpath VALUES (?, ?)", items)
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    # Every write is committed right away, so nothing to flush.
+    def flush(self):
+        pass